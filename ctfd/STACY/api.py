@@ -1,12 +1,12 @@
-import os
-
-import yaml
-from flask import Blueprint, Response, current_app as app, abort
+from flask import Blueprint, Response, current_app as app, abort, request
 from flask_restplus import Api, Resource
 
+from CTFd.cache import cache
+from CTFd.models import Users, Teams
 from CTFd.utils.config import ctf_name, is_teams_mode
 from CTFd.utils.user import get_current_user, is_admin
 from CTFd.utils.decorators import (
+    admins_only,
     during_ctf_time_only,
     require_verified_emails,
     authed_only,
@@ -15,10 +15,11 @@ from CTFd.utils.decorators import (
 from CTFd.utils.decorators.visibility import check_challenge_visibility
 
 from . import backend
+from .client import chad, load_stack
 from .models import GeneratedFlags, CHADChallengeModel
 
-app.config["CHAD_ENDPOINT"] = os.getenv("CHAD_ENDPOINT", "http://chad")
-chad = backend.CHADClient(app.config["CHAD_ENDPOINT"])
+def ping_key(uid, chall_id):
+    return f"stacy_ping_{uid}_{chall_id}"
 
 blueprint = Blueprint("stacy", __name__, url_prefix="/plugins/stacy")
 api = Api(blueprint, prefix="/api", doc=app.config.get("SWAGGER_UI"))
@@ -46,6 +47,103 @@ def get_ovpn():
     res.headers["Content-Disposition"] = f"attachment; filename={ctf_name()}_{name}.ovpn"
     return res
 
+@api.route('/gateways/pool')
+class GatewayPool(Resource):
+    @admins_only
+    def post(self):
+        model = Teams if is_teams_mode() else Users
+        ids = [id_ for id_, in model.query.with_entities(model.id).all()]
+
+        chad.add_gateway_pool(ids)
+        return {"success": True, "count": len(ids)}
+
+@api.route('/challenges/<int:chall_id>/flags')
+class ChallengeFlags(Resource):
+    @admins_only
+    def post(self, chall_id):
+        challenge = CHADChallengeModel.query.filter_by(id=chall_id).first_or_404()
+        if not GeneratedFlags.is_generated(challenge):
+            return {"success": False, "message": "Challenge does not use generated flags"}, 400
+
+        model = Teams if is_teams_mode() else Users
+        column = GeneratedFlags.team_id if is_teams_mode() else GeneratedFlags.user_id
+        # NULLs (e.g. instances launched by admins in teams mode) would make `NOT IN` match nothing at all
+        existing = GeneratedFlags.query.with_entities(column).filter_by(challenge_id=challenge.id) \
+            .filter(column.isnot(None))
+        ids = [id_ for id_, in model.query.with_entities(model.id).filter(model.id.notin_(existing)).all()]
+        if not ids:
+            return {"success": True, "count": 0}
+
+        flags = chad.generate_flags(len(ids), challenge.flag_mode if challenge.flag_mode > 0 else None)
+        GeneratedFlags.create_bulk(challenge, ids, flags)
+        return {"success": True, "count": len(ids)}
+
+@api.route('/challenges/<int:chall_id>/pool')
+class ChallengePool(Resource):
+    @admins_only
+    def put(self, chall_id):
+        challenge = CHADChallengeModel.query.filter_by(id=chall_id).first_or_404()
+        size = int((request.get_json() or {}).get("size", 0))
+
+        chad.set_instance_pool(challenge.id, load_stack(challenge.stack), challenge.service, size)
+        return {"success": True}
+
+@api.route('/instances')
+class Instances(Resource):
+    @during_ctf_time_only
+    @check_challenge_visibility
+    @authed_only
+    @require_team
+    @require_verified_emails
+    def get(self):
+        user = get_current_user()
+        uid = user.team_id if is_teams_mode() else user.id
+
+        instances = chad.list_instances(uid)
+        return {"success": True, "instances": {
+            chall_id: {"services": info["services"], "last_ping": info["last_ping"]}
+            for chall_id, info in instances.items()
+        }}
+
+    @during_ctf_time_only
+    @check_challenge_visibility
+    @authed_only
+    @require_team
+    @require_verified_emails
+    def patch(self):
+        user = get_current_user()
+        uid = user.team_id if is_teams_mode() else user.id
+        data = request.get_json() or {}
+        ids = data.get("challenges", []) if isinstance(data, dict) else None
+        try:
+            if not isinstance(ids, list):
+                raise TypeError()
+            ids = list(map(int, ids))
+        except (TypeError, ValueError):
+            return {"success": False, "message": "challenges must be a list of challenge IDs"}, 400
+        query = CHADChallengeModel.query.with_entities(CHADChallengeModel.id).filter(CHADChallengeModel.id.in_(ids))
+        if not is_admin():
+            query = query.filter(CHADChallengeModel.state != "hidden")
+
+        # Same coalescing as single pings, only forwarding the challenges which haven't been pinged recently
+        instances = {}
+        forward = []
+        for chall_id, in query.all():
+            message = cache.get(ping_key(uid, chall_id))
+            if message is None:
+                forward.append(chall_id)
+            else:
+                instances[chall_id] = not message
+        if forward:
+            for chall_id, exists in chad.ping_instances(uid, forward).items():
+                instances[chall_id] = exists
+                if app.config["CHAD_PING_WINDOW"]:
+                    message = "" if exists else \
+                        f"An instance of challenge ID {chall_id} does not exist for user ID {uid}"
+                    cache.set(ping_key(uid, chall_id), message, timeout=app.config["CHAD_PING_WINDOW"])
+
+        return {"success": True, "instances": instances}
+
 @api.route('/instances/<int:chall_id>')
 class InstanceManagement(Resource):
     @during_ctf_time_only
@@ -66,8 +164,20 @@ class InstanceManagement(Resource):
         except KeyError:
             return {"success": False, "message": "No static flags have been configured"}, 500
 
-        stack = yaml.safe_load(challenge.stack)
+        stack = load_stack(challenge.stack)
+        if app.config["CHAD_ASYNC_CREATE"]:
+            chall_id, service = challenge.id, challenge.service
+            if should_store:
+                # Generated and stored up front, since nothing guarantees anyone polls the job until it's done
+                flag = chad.generate_flags(1, None if flag is True else flag)[0]
+                GeneratedFlags.create(user, challenge, flag)
+
+            job = chad.create_instance_async(uid, chall_id, stack, service, flag)
+            cache.delete(ping_key(uid, chall_id))
+            return {"success": True, "job": job}, 202
+
         info = chad.create_instance(uid, challenge.id, stack, challenge.service, flag)
+        cache.delete(ping_key(uid, challenge.id))
         if should_store:
             GeneratedFlags.create(user, challenge, info['flag'])
 
@@ -84,6 +194,7 @@ class InstanceManagement(Resource):
         challenge = CHADChallengeModel.query.filter_by(id=chall_id).first_or_404()
 
         chad.delete_instance(uid, challenge.id)
+        cache.delete(ping_key(uid, challenge.id))
         return {"success": True}
 
     @during_ctf_time_only
@@ -96,7 +207,9 @@ class InstanceManagement(Resource):
         uid = user.team_id if is_teams_mode() else user.id
         challenge = CHADChallengeModel.query.filter_by(id=chall_id).first_or_404()
 
-        chad.reset_instance(uid, challenge.id)
+        # Waiting means the player is only told the reset is done once their instance is actually back up
+        chad.reset_instance(uid, challenge.id, wait=app.config["CHAD_RESET_WAIT"])
+        cache.delete(ping_key(uid, challenge.id))
         return {"success": True}
 
     @during_ctf_time_only
@@ -109,9 +222,43 @@ class InstanceManagement(Resource):
         uid = user.team_id if is_teams_mode() else user.id
         challenge = CHADChallengeModel.query.filter_by(id=chall_id).first_or_404()
 
-        chad.ping_instance(uid, challenge.id)
+        # Only forward one ping per team / user and challenge every window (e.g. when several teammates have the
+        # challenge open), answering the rest with the outcome of the last one
+        key = ping_key(uid, challenge.id)
+        message = cache.get(key)
+        if message is None:
+            try:
+                chad.ping_instance(uid, challenge.id)
+                message = ""
+            except backend.InstanceNotFoundError as ex:
+                message = str(ex)
+            if app.config["CHAD_PING_WINDOW"]:
+                cache.set(key, message, timeout=app.config["CHAD_PING_WINDOW"])
+
+        if message:
+            return {"success": False, "message": message}, 404
         return {"success": True}
 
+@api.route('/instances/<int:chall_id>/jobs/<job_id>')
+class InstanceJob(Resource):
+    @during_ctf_time_only
+    @check_challenge_visibility
+    @authed_only
+    @require_team
+    @require_verified_emails
+    def get(self, chall_id, job_id):
+        user = get_current_user()
+        uid = user.team_id if is_teams_mode() else user.id
+        challenge = CHADChallengeModel.query.filter_by(id=chall_id).first_or_404()
+
+        job = chad.get_job(job_id)
+        if job["args"]["user_id"] != uid or job["args"]["challenge_id"] != challenge.id:
+            abort(404)
+
+        if job["status"] == "failed":
+            return {"success": True, "status": job["status"], "message": job["error"]}
+        return {"success": True, "status": job["status"]}
+
 
 @api.errorhandler(backend.InstanceNotFoundError)
 def err_instance_not_found(e):
@@ -120,3 +267,17 @@ def err_instance_not_found(e):
 @api.errorhandler(backend.InstanceExistsError)
 def err_instance_exists(e):
     return {"success": False, "message": str(e)}, 409
+
+@api.errorhandler(backend.InstanceTimeoutError)
+def err_instance_timeout(e):
+    return {"success": False, "message": str(e)}, 504
+
+@api.errorhandler(backend.CapacityError)
+def err_capacity(e):
+    headers = {"Retry-After": e.retry_after} if e.retry_after else {}
+    return {"success": False, "message": f"{e}, please try again shortly"}, 503, headers
+
+# Registered last since handlers are matched in order (and this would catch the more specific errors)
+@api.errorhandler(backend.CHADError)
+def err_chad(e):
+    return {"success": False, "message": str(e)}, 400
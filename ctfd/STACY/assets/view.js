@@ -35,6 +35,26 @@ function stacyActionButton(selector, action) {
             .then(done, done);
     })
 }
+function stacyWaitJob(challengeId, jobId) {
+    return new Promise(resolve => setTimeout(resolve, 1000))
+        .then(() => CTFd.fetch(`/plugins/stacy/api/instances/${challengeId}/jobs/${jobId}`, {
+            method: 'GET',
+            credentials: 'same-origin',
+            headers: {
+                'Accept': 'application/json'
+            }
+        }))
+        .then(stacyResCheck)
+        .then(r => {
+            if (r.status == 'failed') {
+                throw r.message;
+            }
+            if (r.status != 'done') {
+                return stacyWaitJob(challengeId, jobId);
+            }
+            return r;
+        });
+}
 function stacyPing(challengeId) {
     CTFd.fetch(`/plugins/stacy/api/instances/${challengeId}`, {
         method: 'PATCH',
@@ -84,6 +104,7 @@ CTFd._internal.challenge.postRender = function () {
             }
         })
             .then(stacyResCheck)
+            .then(r => r.job ? stacyWaitJob(challengeId, r.job) : r)
             .then(() => stacyPing(challengeId))
             .catch(e => {
                 console.log(e);
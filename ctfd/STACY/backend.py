@@ -1,4 +1,6 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 class CHADError(Exception):
     pass
@@ -6,29 +8,101 @@ class InstanceExistsError(CHADError):
     pass
 class InstanceNotFoundError(CHADError):
     pass
+class InstanceTimeoutError(CHADError):
+    pass
+class CapacityError(CHADError):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
 
 class CHADClient:
-    def __init__(self, endpoint):
+    # Resetting restarts services and creating deploys a stack, so only calls which are safe to repeat are retried
+    RETRY_METHODS = frozenset(['HEAD', 'GET', 'OPTIONS', 'PATCH', 'DELETE'])
+
+    def __init__(self, endpoint, pool_size=10, connect_timeout=3.05, read_timeout=60, create_timeout=300,
+        retries=3, backoff=0.2):
         self.endpoint = endpoint
+        self.timeout = (connect_timeout, read_timeout)
+        self.create_timeout = (connect_timeout, create_timeout)
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=Retry(
+            total=retries,
+            backoff_factor=backoff,
+            method_whitelist=self.RETRY_METHODS,
+            status_forcelist=(502, 503, 504),
+            raise_on_status=False
+        ))
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _request(self, method, path, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, f'{self.endpoint}{path}', **kwargs)
 
     def __raise_status(self, res):
+        if res.status_code == 504 and res.headers.get('content-type', '').startswith('application/json'):
+            raise InstanceTimeoutError(res.json().get('message', 'timed out'))
+        if res.status_code == 503 and res.headers.get('content-type', '').startswith('application/json'):
+            raise CapacityError(res.json().get('message', 'at capacity'), res.headers.get('Retry-After'))
         if res.status_code < 400 or res.status_code >= 500:
             return
 
         message = res.json().get('message', 'unknown error')
+        if res.status_code == 400:
+            raise CHADError(message)
         if res.status_code == 404:
             raise InstanceNotFoundError(message)
         elif res.status_code == 409:
             raise InstanceExistsError(message)
 
     def get_ovpn(self, user_id):
-        res = requests.get(f'{self.endpoint}/gateways/{user_id}/ovpn/client')
+        res = self._request('GET', f'/gateways/{user_id}/ovpn/client')
         res.raise_for_status()
 
         return res.text
 
+    def add_gateway_pool(self, user_ids):
+        res = self._request('POST', '/gateways/pool', json={'users': user_ids})
+        self.__raise_status(res)
+        res.raise_for_status()
+
+    def generate_flags(self, count, length=None):
+        res = self._request('POST', '/flags/batch', json={'count': count, 'length': length})
+        self.__raise_status(res)
+        res.raise_for_status()
+
+        return res.json()['flags']
+
+    def prepull_images(self, stack):
+        res = self._request('POST', '/images/prepull', json={'stack': stack})
+        self.__raise_status(res)
+        res.raise_for_status()
+
+        return res.json()['job']
+
+    def set_instance_pool(self, chall_id, stack, service, size=None):
+        res = self._request('PUT', f'/pool/{chall_id}', json={
+            'stack': stack,
+            'service': service,
+            'size': size
+        })
+        self.__raise_status(res)
+        res.raise_for_status()
+
     def create_instance(self, user_id, chall_id, stack, service, flag):
-        res = requests.post(f'{self.endpoint}/instances/{user_id}/{chall_id}', json={
+        res = self._request('POST', f'/instances/{user_id}/{chall_id}', json={
+            'stack': stack,
+            'service': service,
+            'flag': flag
+        }, timeout=self.create_timeout)
+        self.__raise_status(res)
+        res.raise_for_status()
+
+        return res.json()
+
+    def create_instance_async(self, user_id, chall_id, stack, service, flag):
+        res = self._request('POST', f'/instances/{user_id}/{chall_id}', params={'async': 1}, json={
             'stack': stack,
             'service': service,
             'flag': flag
@@ -36,19 +110,41 @@ class CHADClient:
         self.__raise_status(res)
         res.raise_for_status()
 
+        return res.json()['job']
+
+    def get_job(self, job_id):
+        res = self._request('GET', f'/jobs/{job_id}')
+        self.__raise_status(res)
+        res.raise_for_status()
+
         return res.json()
 
     def delete_instance(self, user_id, chall_id):
-        res = requests.delete(f'{self.endpoint}/instances/{user_id}/{chall_id}')
+        res = self._request('DELETE', f'/instances/{user_id}/{chall_id}')
         self.__raise_status(res)
         res.raise_for_status()
 
-    def reset_instance(self, user_id, chall_id):
-        res = requests.put(f'{self.endpoint}/instances/{user_id}/{chall_id}')
+    def reset_instance(self, user_id, chall_id, wait=False):
+        res = self._request('PUT', f'/instances/{user_id}/{chall_id}', params={'wait': 1} if wait else None,
+            timeout=self.create_timeout if wait else self.timeout)
         self.__raise_status(res)
         res.raise_for_status()
 
     def ping_instance(self, user_id, chall_id):
-        res = requests.patch(f'{self.endpoint}/instances/{user_id}/{chall_id}')
+        res = self._request('PATCH', f'/instances/{user_id}/{chall_id}')
+        self.__raise_status(res)
+        res.raise_for_status()
+
+    def list_instances(self, user_id):
+        res = self._request('GET', f'/instances/{user_id}')
         self.__raise_status(res)
         res.raise_for_status()
+
+        return {int(k): v for k, v in res.json()['instances'].items()}
+
+    def ping_instances(self, user_id, chall_ids):
+        res = self._request('PATCH', f'/instances/{user_id}', json={'challenges': chall_ids})
+        self.__raise_status(res)
+        res.raise_for_status()
+
+        return {int(k): v for k, v in res.json()['instances'].items()}
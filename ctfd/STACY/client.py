@@ -0,0 +1,34 @@
+import os
+import copy
+import functools
+
+import yaml
+from flask import current_app as app
+
+from . import backend
+
+app.config["CHAD_ENDPOINT"] = os.getenv("CHAD_ENDPOINT", "http://chad")
+app.config["CHAD_ASYNC_CREATE"] = bool(os.getenv("CHAD_ASYNC_CREATE"))
+app.config["CHAD_POOL_SIZE"] = int(os.getenv("CHAD_POOL_SIZE", "10"))
+app.config["CHAD_CONNECT_TIMEOUT"] = float(os.getenv("CHAD_CONNECT_TIMEOUT", "3.05"))
+app.config["CHAD_READ_TIMEOUT"] = float(os.getenv("CHAD_READ_TIMEOUT", "60"))
+app.config["CHAD_CREATE_TIMEOUT"] = float(os.getenv("CHAD_CREATE_TIMEOUT", "300"))
+app.config["CHAD_RETRIES"] = int(os.getenv("CHAD_RETRIES", "3"))
+app.config["CHAD_RESET_WAIT"] = os.getenv("CHAD_RESET_WAIT", "1") == "1"
+app.config["CHAD_PING_WINDOW"] = int(os.getenv("CHAD_PING_WINDOW", "5"))
+chad = backend.CHADClient(
+    app.config["CHAD_ENDPOINT"],
+    pool_size=app.config["CHAD_POOL_SIZE"],
+    connect_timeout=app.config["CHAD_CONNECT_TIMEOUT"],
+    read_timeout=app.config["CHAD_READ_TIMEOUT"],
+    create_timeout=app.config["CHAD_CREATE_TIMEOUT"],
+    retries=app.config["CHAD_RETRIES"]
+)
+
+@functools.lru_cache(maxsize=128)
+def parse_stack(text):
+    return yaml.safe_load(text)
+
+def load_stack(text):
+    """Parses a challenge's stack YAML, returning a copy so that the cached parse can't be modified"""
+    return copy.deepcopy(parse_stack(text))
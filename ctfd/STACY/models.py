@@ -1,6 +1,7 @@
 from __future__ import division  # Use floating point for math calculations
 import math
 
+import requests
 from sqlalchemy import or_
 from flask import Blueprint, current_app as app
 
@@ -23,6 +24,9 @@ from CTFd.utils.modes import get_model
 from CTFd.plugins.challenges import BaseChallenge
 from CTFd.plugins.flags import get_flag_class
 
+from . import backend
+from .client import chad, load_stack
+
 class GeneratedFlags(db.Model):
     __tablename__ = "generated_flags"
     id = db.Column(db.Integer, primary_key=True)
@@ -78,6 +82,16 @@ class GeneratedFlags(db.Model):
         db.session.close()
         return flag
 
+    @classmethod
+    def create_bulk(cls, challenge, account_ids, values):
+        column = "team_id" if is_teams_mode() else "user_id"
+        db.session.bulk_insert_mappings(cls, [
+            {column: account_id, "challenge_id": challenge.id, "value": value}
+            for account_id, value in zip(account_ids, values)
+        ])
+        db.session.commit()
+        db.session.close()
+
     @classmethod
     def get(cls, user, challenge):
         if is_teams_mode() and not is_admin():
@@ -193,8 +207,30 @@ class CHADChallenge(BaseChallenge):
         db.session.add(challenge)
         db.session.commit()
 
+        CHADChallenge.sync(challenge)
         return challenge
 
+    @staticmethod
+    def sync(challenge, update_pool=False):
+        """
+        Lets CHAD know about a challenge's stack, so that its images are pulled onto every node ahead of anyone
+        launching it (and so any warm instances use it).
+        """
+        if not challenge.stack:
+            return
+        stack = load_stack(challenge.stack)
+        if update_pool:
+            try:
+                chad.set_instance_pool(challenge.id, stack, challenge.service)
+            except (backend.CHADError, requests.RequestException) as ex:
+                # Warm instances keep being made from the old stack, which launches won't match (so they just deploy)
+                app.logger.warning(f"Failed to update instance pool for challenge {challenge.id}: {ex}")
+        try:
+            chad.prepull_images(stack)
+        except (backend.CHADError, requests.RequestException) as ex:
+            # Nothing is lost other than the first launch on each node being slower
+            app.logger.warning(f"Failed to pre-pull images for challenge {challenge.id}: {ex}")
+
     @staticmethod
     def read(challenge):
         """
@@ -243,6 +279,9 @@ class CHADChallenge(BaseChallenge):
                 value = float(value)
             setattr(challenge, attr, value)
 
+        if "stack" in data or "service" in data:
+            CHADChallenge.sync(challenge, update_pool=True)
+
         return CHADChallenge.calculate_value(challenge)
 
     @staticmethod
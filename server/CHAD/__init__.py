@@ -9,49 +9,141 @@ from werkzeug.exceptions import InternalServerError
 from marshmallow.exceptions import ValidationError
 from flask import Flask, jsonify
 
-from .util import var_or_secret
-from . import stack, pki, challenges, cleanup
+from .util import var_or_secret, parse_id_list
+from . import stack, pki, challenges, cleanup, jobs
 
 app = Flask(__name__)
 app.config.update({
     'DOCKER_REGISTRY': os.getenv('DOCKER_REGISTRY', 'example.com'),
     'ID_SALT': var_or_secret('ID_SALT', 'TESTTESTTEST'),
     'FLAG_PREFIX': os.getenv('FLAG_PREFIX', 'CTF'),
+    'FLAG_TABLE': os.getenv('FLAG_TABLE', '/var/lib/chad/flags.bin'),
+    'FLAG_TTL': int(os.getenv('FLAG_TTL', str(30 * 86400))),
     'REDIS_URL': os.getenv('REDIS_URL', 'redis://redis'),
     'GATEWAY_IMAGE': os.getenv('GATEWAY_IMAGE', 'chad-gateway'),
     'GATEWAY_DOMAIN': os.getenv('GATEWAY_PROXY', 'chad-gw.sys.hacktrinity.org'),
     'TRAEFIK_NETWORK': os.getenv('TRAEFIK_NETWORK', 'traefik'),
-    'CLEANUP_INTERVAL': int(os.getenv('CLEANUP_INTERVAL', '30')),
+    'CLEANUP_INTERVAL': int(os.getenv('CLEANUP_INTERVAL', '300')),
+    'CLEANUP_HOUSEKEEPING_INTERVAL': int(os.getenv('CLEANUP_HOUSEKEEPING_INTERVAL', '30')),
     'CLEANUP_INSTANCE_TIMEOUT': int(os.getenv('CLEANUP_INSTANCE_TIMEOUT', '60')),
     'CLEANUP_GATEWAY_TIMEOUT': int(os.getenv('CLEANUP_GATEWAY_TIMEOUT', '120')),
-    'NETWORK_PLUGIN': os.getenv('NETWORK_PLUGIN', 'weaveworks/net-plugin:latest_release')
+    'CLEANUP_CONCURRENCY': int(os.getenv('CLEANUP_CONCURRENCY', '8')),
+    'CLEANUP_RETRY_DELAY': int(os.getenv('CLEANUP_RETRY_DELAY', '10')),
+    'CLEANUP_SHARD_GRACE': int(os.getenv('CLEANUP_SHARD_GRACE', '30')),
+    'NETWORK_PLUGIN': os.getenv('NETWORK_PLUGIN', 'weaveworks/net-plugin:latest_release'),
+    'STACK_INVENTORY_INTERVAL': int(os.getenv('STACK_INVENTORY_INTERVAL', '30')),
+    'STACK_INVENTORY_CONVERGE_INTERVAL': float(os.getenv('STACK_INVENTORY_CONVERGE_INTERVAL', '2')),
+    'STACK_INVENTORY_CONVERGE_WINDOW': int(os.getenv('STACK_INVENTORY_CONVERGE_WINDOW', '60')),
+    'STACK_BACKEND': os.getenv('STACK_BACKEND', 'cli'),
+    'STACK_TEMPLATE_CACHE_SIZE': int(os.getenv('STACK_TEMPLATE_CACHE_SIZE', '128')),
+    'PKI_BACKEND': os.getenv('PKI_BACKEND', 'easyrsa'),
+    'PKI_KEY_SIZE': int(os.getenv('PKI_KEY_SIZE', '2048')),
+    'PKI_KEY_POOL_SIZE': int(os.getenv('PKI_KEY_POOL_SIZE', '0')),
+    'PKI_KEY_POOL_REFILL_RATE': float(os.getenv('PKI_KEY_POOL_REFILL_RATE', '2')),
+    'GATEWAY_POOL_USERS': parse_id_list(os.getenv('GATEWAY_POOL_USERS')),
+    'GATEWAY_POOL_CONCURRENCY': int(os.getenv('GATEWAY_POOL_CONCURRENCY', '4')),
+    'RESET_TIMEOUT': int(os.getenv('RESET_TIMEOUT', '60')),
+    'INSTANCE_POOL_CONCURRENCY': int(os.getenv('INSTANCE_POOL_CONCURRENCY', '4')),
+    'PREPULL_TIMEOUT': int(os.getenv('PREPULL_TIMEOUT', '600')),
+    'PREPULL_POLL_INTERVAL': float(os.getenv('PREPULL_POLL_INTERVAL', '2')),
+    'MAX_INSTANCES': int(os.getenv('MAX_INSTANCES', '0')),
+    'MAX_NODE_INSTANCES': int(os.getenv('MAX_NODE_INSTANCES', '0')),
+    'MAX_USER_INSTANCES': int(os.getenv('MAX_USER_INSTANCES', '0')),
+    'MAX_DEPLOYS': int(os.getenv('MAX_DEPLOYS', '0')),
+    'MAX_USER_DEPLOYS': int(os.getenv('MAX_USER_DEPLOYS', '0')),
+    'ADMISSION_WAIT': float(os.getenv('ADMISSION_WAIT', '0')),
+    'ADMISSION_POLL_INTERVAL': float(os.getenv('ADMISSION_POLL_INTERVAL', '0.5')),
+    'ADMISSION_RETRY_AFTER': int(os.getenv('ADMISSION_RETRY_AFTER', '5')),
+    'FLIGHT_TTL': int(os.getenv('FLIGHT_TTL', '600')),
+    'DEPLOY_WORKERS': int(os.getenv('DEPLOY_WORKERS', '4')),
+    'PREPULL_WORKERS': int(os.getenv('PREPULL_WORKERS', '2')),
+    'JOB_TTL': int(os.getenv('JOB_TTL', '3600'))
 })
 
 app.redis = redis.from_url(app.config['REDIS_URL'])
-app.pki = pki.PKI(domain=app.config['GATEWAY_DOMAIN'])
+app.docker = docker.from_env()
+app.key_pool = pki.KeyPool(
+    app.redis,
+    size=app.config['PKI_KEY_POOL_SIZE'],
+    refill_rate=app.config['PKI_KEY_POOL_REFILL_RATE'],
+    key_size=app.config['PKI_KEY_SIZE']
+)
+app.pki = pki.PKI(
+    domain=app.config['GATEWAY_DOMAIN'],
+    redis=app.redis,
+    backend=app.config['PKI_BACKEND'],
+    key_pool=app.key_pool if app.config['PKI_KEY_POOL_SIZE'] else None
+)
+app.stack_inventory = stack.StackInventory(app.docker, interval=app.config['STACK_INVENTORY_INTERVAL'],
+    converge_interval=app.config['STACK_INVENTORY_CONVERGE_INTERVAL'],
+    converge_window=app.config['STACK_INVENTORY_CONVERGE_WINDOW'])
+if app.config['STACK_BACKEND'] == 'api':
+    app.stacks = stack.APIStackManager(app.docker, inventory=app.stack_inventory)
+else:
+    app.stacks = stack.StackManager(inventory=app.stack_inventory)
 app.challenges = challenges.ChallengeManager(
-    docker.from_env(),
+    app.docker,
     app.pki,
-    stack.StackManager(),
+    app.stacks,
     app.redis,
     app.config['ID_SALT'],
     docker_registry=app.config['DOCKER_REGISTRY'],
     flag_prefix=app.config['FLAG_PREFIX'],
+    flag_table=app.config['FLAG_TABLE'],
+    flag_ttl=app.config['FLAG_TTL'],
     instance_timeout=app.config['CLEANUP_INSTANCE_TIMEOUT'],
     gateway_timeout=app.config['CLEANUP_GATEWAY_TIMEOUT'],
     gateway_image=app.config['GATEWAY_IMAGE'],
     gateway_domain=app.config['GATEWAY_DOMAIN'],
     traefik_network=app.config['TRAEFIK_NETWORK'],
-    network_plugin=app.config['NETWORK_PLUGIN']
+    network_plugin=app.config['NETWORK_PLUGIN'],
+    gateway_pool=app.config['GATEWAY_POOL_USERS'],
+    gateway_pool_concurrency=app.config['GATEWAY_POOL_CONCURRENCY'],
+    cleanup_concurrency=app.config['CLEANUP_CONCURRENCY'],
+    retry_delay=app.config['CLEANUP_RETRY_DELAY'],
+    shard_grace=app.config['CLEANUP_SHARD_GRACE'],
+    template_cache_size=app.config['STACK_TEMPLATE_CACHE_SIZE'],
+    reset_timeout=app.config['RESET_TIMEOUT'],
+    instance_pool_concurrency=app.config['INSTANCE_POOL_CONCURRENCY'],
+    prepull_timeout=app.config['PREPULL_TIMEOUT'],
+    prepull_poll_interval=app.config['PREPULL_POLL_INTERVAL'],
+    max_instances=app.config['MAX_INSTANCES'],
+    max_node_instances=app.config['MAX_NODE_INSTANCES'],
+    max_user_instances=app.config['MAX_USER_INSTANCES'],
+    max_deploys=app.config['MAX_DEPLOYS'],
+    max_user_deploys=app.config['MAX_USER_DEPLOYS'],
+    admission_wait=app.config['ADMISSION_WAIT'],
+    admission_poll_interval=app.config['ADMISSION_POLL_INTERVAL'],
+    admission_retry_after=app.config['ADMISSION_RETRY_AFTER'],
+    flight_ttl=app.config['FLIGHT_TTL']
 )
 app.cleanup = cleanup.Cleanup(
     app.challenges,
-    interval=app.config['CLEANUP_INTERVAL']
+    interval=app.config['CLEANUP_INTERVAL'],
+    housekeeping_interval=app.config['CLEANUP_HOUSEKEEPING_INTERVAL']
 )
+def create_job(**args):
+    result = app.challenges.create(**args)
+    if isinstance(args.get('flag'), str):
+        # The caller chose the flag (e.g. STACY generates it up front), so it isn't kept in the job's result too
+        result.pop('flag', None)
+    return result
+
+app.jobs = jobs.JobQueue(app.redis, ttl=app.config['JOB_TTL'])
+app.worker = jobs.Worker(app.jobs, {'create': create_job}, concurrency=app.config['DEPLOY_WORKERS'])
+# Pre-pulls can take minutes, so they get their own queue and workers rather than holding up instance creation
+app.prepull_jobs = jobs.JobQueue(app.redis, ttl=app.config['JOB_TTL'], queue='prepull')
+app.prepull_worker = jobs.Worker(app.prepull_jobs, {'prepull': app.challenges.prepull},
+    concurrency=app.config['PREPULL_WORKERS'])
 
 with app.app_context():
     from . import api
 
+@app.before_first_request
+def start_inventory():
+    # Only the API server keeps an inventory, everything else (cleanup, workers etc.) lists stacks when it needs them
+    app.stack_inventory.start()
+
 @app.errorhandler(404)
 def not_found(_e):
     return jsonify({'message': 'not found'}), 404
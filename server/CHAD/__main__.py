@@ -1,17 +1,98 @@
 import sys
+import json
+import time
+import subprocess
+import argparse
+import multiprocessing
 
-from . import app
+from . import app, challenges
+from .util import parse_id_list
 
-def usage():
-    print(f'usage: {sys.argv[0]} <serve|periodic>', file=sys.stderr)
-    sys.exit(1)
+def provision_ids(user_ids):
+    provisioned, failed = 0, 0
+    for user_id in user_ids:
+        try:
+            if app.pki.provision(user_id, challenges.POOL_START, challenges.POOL_END, challenges.NETWORK):
+                provisioned += 1
+        except Exception as ex: # pylint: disable=broad-except
+            print(f'failed to provision user {user_id}: {ex}', file=sys.stderr)
+            failed += 1
+    return provisioned, failed
 
-if len(sys.argv) != 2:
-    usage()
+def provision(args):
+    user_ids = parse_id_list(args.ids)
+    start = time.monotonic()
 
-if sys.argv[1] == 'cleanup':
-    app.cleanup.run()
-elif sys.argv[1] == 'serve':
-    app.run(debug=True, host='0.0.0.0', port=80)
-else:
-    usage()
+    if args.summary or args.jobs <= 1:
+        provisioned, failed = provision_ids(user_ids)
+    else:
+        # Separate interpreters rather than forking, which doesn't mix well with gevent's monkey patching. Importing
+        # the app is cheap enough for this, since nothing talks to Docker (or starts the stack inventory) until it's
+        # actually used.
+        chunks = filter(lambda c: c, map(lambda i: user_ids[i::args.jobs], range(args.jobs)))
+        procs = list(map(lambda c: subprocess.Popen(
+            [sys.executable, '-m', 'CHAD', 'provision', '--summary', ','.join(map(str, c))],
+            stdout=subprocess.PIPE, encoding='utf-8'), chunks))
+
+        provisioned, failed = 0, 0
+        try:
+            for proc in procs:
+                output, _ = proc.communicate()
+                if proc.returncode != 0:
+                    print(f'provisioning process exited with code {proc.returncode}', file=sys.stderr)
+                    sys.exit(proc.returncode)
+                summary = json.loads(output.strip().split('\n')[-1])
+                provisioned += summary['provisioned']
+                failed += summary['failed']
+        finally:
+            # Don't leave the rest running after one of them has failed (or on ^C)
+            for proc in procs:
+                if proc.poll() is None:
+                    proc.terminate()
+            for proc in procs:
+                proc.wait()
+
+    if args.summary:
+        print(json.dumps({'provisioned': provisioned, 'failed': failed}))
+        return
+
+    duration = time.monotonic() - start
+    skipped = len(user_ids) - provisioned - failed
+    print(f'provisioned {provisioned} users ({skipped} already complete, {failed} failed) in {duration:.1f}s ' +
+        f'({provisioned / duration:.1f} users/s)')
+    if failed:
+        sys.exit(1)
+
+def keygen(_args):
+    if app.config['PKI_BACKEND'] != 'cryptography':
+        sys.exit('the key pool is only used by the cryptography PKI backend')
+    app.key_pool.run()
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m CHAD', description='CHAD server')
+    commands = parser.add_subparsers(required=True, dest='command')
+
+    c_serve = commands.add_parser('serve', help='Run development server')
+    c_serve.set_defaults(fn=lambda _args: app.run(debug=True, host='0.0.0.0', port=80))
+
+    c_cleanup = commands.add_parser('cleanup', help='Run cleanup process')
+    c_cleanup.set_defaults(fn=lambda _args: app.cleanup.run())
+
+    c_worker = commands.add_parser('worker', help='Run background job worker')
+    c_worker.set_defaults(fn=lambda args: (app.prepull_worker if args.prepull else app.worker).run())
+    c_worker.add_argument('--prepull', action='store_true', help='Run image pre-pull jobs (instead of creates)')
+
+    c_keygen = commands.add_parser('keygen', help='Run PKI key pool producer')
+    c_keygen.set_defaults(fn=keygen)
+
+    c_provision = commands.add_parser('provision', help='Provision PKI for users ahead of time')
+    c_provision.set_defaults(fn=provision)
+    c_provision.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+        help='Number of processes to provision with')
+    c_provision.add_argument('--summary', action='store_true', help=argparse.SUPPRESS)
+    c_provision.add_argument('ids', help='User IDs and ID ranges (e.g. 1-100,105)')
+
+    args = parser.parse_args()
+    args.fn(args)
+
+main()
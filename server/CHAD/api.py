@@ -1,9 +1,9 @@
 import ipaddress
 
-from marshmallow import Schema, fields, post_load, ValidationError
-from flask import current_app as app, jsonify
+from marshmallow import Schema, fields, validate, post_load, ValidationError
+from flask import current_app as app, jsonify, request, url_for
 
-from . import util, challenges
+from . import util, challenges, jobs
 from .util import parse_body
 
 def validate_network(n):
@@ -28,6 +28,39 @@ class CreateInstanceSchema(Schema):
 
 create_schema = CreateInstanceSchema()
 
+class GatewayPoolSchema(Schema):
+    users = fields.List(fields.Int(), required=True)
+
+gateway_pool_schema = GatewayPoolSchema()
+
+class FlagBatchSchema(Schema):
+    count = fields.Int(required=True, validate=validate.Range(min=1, max=10000))
+    length = fields.Int(allow_none=True)
+
+flag_batch_schema = FlagBatchSchema()
+
+class InstancePoolSchema(Schema):
+    stack = fields.Dict(required=True)
+    service = fields.Str(required=True)
+    size = fields.Int(allow_none=True, validate=validate.Range(min=0))
+
+instance_pool_schema = InstancePoolSchema()
+
+class PrepullSchema(Schema):
+    stack = fields.Dict(required=True)
+
+prepull_schema = PrepullSchema()
+
+class PingSchema(Schema):
+    challenges = fields.List(fields.Int(), required=True)
+
+ping_schema = PingSchema()
+
+class PingAllSchema(Schema):
+    users = fields.Dict(keys=fields.Int(), values=fields.List(fields.Int()), required=True)
+
+ping_all_schema = PingAllSchema()
+
 
 @app.route('/gateways/<int:user_id>', methods=['POST'])
 def gateway_create(user_id):
@@ -39,6 +72,13 @@ def gateway_delete(user_id):
     app.challenges.ensure_gateway_gone(user_id)
     return '', 204
 
+@app.route('/gateways/pool', methods=['POST'])
+@parse_body(gateway_pool_schema)
+def gateway_pool_add(b):
+    # Standby gateways are prepared in the background by the cleanup process
+    app.challenges.add_gateway_pool_users(b['users'])
+    return '', 202
+
 @app.route('/gateways/<int:user_id>/ovpn/client')
 def ovpn_client_get(user_id):
     return app.pki.generate_client_ovpn(user_id)
@@ -49,9 +89,37 @@ if app.debug:
         return app.pki.generate_server_ovpn(user_id, challenges.POOL_START, challenges.POOL_END, challenges.NETWORK)
 
 
+@app.route('/pki/keys')
+def pki_keys_get():
+    return jsonify(app.key_pool.stats())
+
+
+@app.route('/flags/batch', methods=['POST'])
+@parse_body(flag_batch_schema)
+def flags_batch(b):
+    return jsonify({'flags': app.challenges.generate_flags(b['count'], b.get('length'))})
+
+
 @app.route('/instances/<int:user_id>/<int:challenge_id>', methods=['POST'])
 @parse_body(create_schema)
 def instance_create(b, user_id, challenge_id):
+    if request.args.get('async') or 'respond-async' in request.headers.get('Prefer', ''):
+        if app.stacks.exists(challenges.stack_name(user_id, challenge_id)):
+            raise challenges.InstanceExistsError(
+                f'An instance of challenge ID {challenge_id} already exists for user ID {user_id}')
+        # Refused here, since a job that fails for lack of room can't tell the client when to try again
+        app.challenges.check_capacity(user_id)
+
+        job_id = app.jobs.submit(
+            'create',
+            user_id=user_id,
+            challenge_id=challenge_id,
+            stack=b['stack'],
+            service=b['service'],
+            flag=b['flag']
+        )
+        return jsonify({'job': job_id}), 202, {'Location': url_for('job_get', job_id=job_id)}
+
     return jsonify(app.challenges.create(
         user_id,
         challenge_id,
@@ -65,9 +133,42 @@ def instance_ping(user_id, challenge_id):
     app.challenges.ping(user_id, challenge_id)
     return '', 204
 
+@app.route('/images/prepull', methods=['POST'])
+@parse_body(prepull_schema)
+def images_prepull(b):
+    job_id = app.prepull_jobs.submit('prepull', stack=b['stack'])
+    return jsonify({'job': job_id}), 202, {'Location': url_for('job_get', job_id=job_id)}
+
+
+@app.route('/pool')
+def instance_pool_get():
+    return jsonify(app.challenges.instance_pool())
+
+@app.route('/pool/<int:challenge_id>', methods=['PUT'])
+@parse_body(instance_pool_schema)
+def instance_pool_set(b, challenge_id):
+    # Warm instances are deployed in the background by the cleanup process
+    app.challenges.set_instance_pool(challenge_id, b['stack'], b['service'], b.get('size'))
+    return '', 202
+
+
+@app.route('/instances/<int:user_id>')
+def instances_list(user_id):
+    return jsonify({'instances': app.challenges.list_instances(user_id)})
+
+@app.route('/instances/<int:user_id>', methods=['PATCH'])
+@parse_body(ping_schema)
+def instances_ping(b, user_id):
+    return jsonify({'instances': app.challenges.ping_many({user_id: b['challenges']})[user_id]})
+
+@app.route('/instances', methods=['PATCH'])
+@parse_body(ping_all_schema)
+def instances_ping_all(b):
+    return jsonify({'users': app.challenges.ping_many(b['users'])})
+
 @app.route('/instances/<int:user_id>/<int:challenge_id>', methods=['PUT'])
 def instance_reset(user_id, challenge_id):
-    app.challenges.reset(user_id, challenge_id)
+    app.challenges.reset(user_id, challenge_id, wait=bool(request.args.get('wait')))
     return '', 204
 
 @app.route('/instances/<int:user_id>/<int:challenge_id>', methods=['DELETE'])
@@ -75,6 +176,13 @@ def instance_delete(user_id, challenge_id):
     app.challenges.delete(user_id, challenge_id)
     return '', 204
 
+@app.route('/jobs/<job_id>')
+def job_get(job_id):
+    job = app.jobs.get(job_id)
+    # A flag the caller chose is only needed to run the job. Generated ones are handed out in the result (only).
+    job['args'] = {k: v for k, v in job['args'].items() if k != 'flag'}
+    return jsonify(job)
+
 
 @app.errorhandler(util.FlagLengthError)
 def err_flag_length(e):
@@ -87,3 +195,23 @@ def err_instance_not_found(e):
 @app.errorhandler(challenges.InstanceExistsError)
 def err_instance_exists(e):
     return jsonify({'message': str(e)}), 409
+
+@app.errorhandler(challenges.ResetTimeoutError)
+def err_reset_timeout(e):
+    return jsonify({'message': str(e)}), 504
+
+@app.errorhandler(challenges.InstancePoolError)
+def err_instance_pool(e):
+    return jsonify({'message': str(e)}), 400
+
+@app.errorhandler(challenges.FlightError)
+def err_flight(e):
+    return jsonify({'message': str(e)}), 500
+
+@app.errorhandler(challenges.CapacityError)
+def err_capacity(e):
+    return jsonify({'message': str(e)}), 503, {'Retry-After': str(e.retry_after)}
+
+@app.errorhandler(jobs.JobNotFoundError)
+def err_job_not_found(e):
+    return jsonify({'message': str(e)}), 404
@@ -1,15 +1,19 @@
-from string import Template
+from collections import OrderedDict
+import contextlib
 import re
 import json
-import tempfile
+import hashlib
 import time
 import ipaddress
+import zlib
+import uuid
 
-import dpath.util as dpath
 import hashids
 import docker
+import gevent.pool
 
 from . import util, pki
+from . import stack as stack_
 
 LABEL_PREFIX = 'org.hacktrinity.chad'
 
@@ -19,6 +23,91 @@ POOL_END = ipaddress.IPv4Address('192.168.255.254')
 
 GATEWAY_SERVICE_REGEX = re.compile('chad_(\\d+)_gw$')
 
+# Sorted sets of last ping timestamps, keyed by stack / gateway service name
+INSTANCE_PINGS = 'chad_instance_pings'
+GATEWAY_PINGS = 'chad_gateway_pings'
+CLEANUP_CLAIM_PREFIX = 'chad_cleanup_claim_'
+# Set of every flag generated (until none have been generated for `flag_ttl` seconds)
+FLAGS = 'chad_flags'
+# Warm instance pool: a hash of challenge IDs to pool specs, sets of unclaimed warm stacks (per challenge ID and stack
+# hash), a hash of warm stacks to the set they're in and a hash of claimed instances to their original warm stack
+INSTANCE_POOL_SPECS = 'chad_instance_pool'
+INSTANCE_POOL_PREFIX = 'chad_instance_pool_'
+INSTANCE_POOL_STACKS = 'chad_instance_pool_stacks'
+INSTANCE_POOL_CLAIMED = 'chad_instance_pool_claimed'
+POOL_STACK_PREFIX = 'chad_pool_'
+# Single-flight locks (and outcome lists) for operations on instances and gateways
+FLIGHT_PREFIX = 'chad_flight_'
+# Deletes a lock only if it's still held with the given token
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+# Hash of service IDs to the update config they had before a reset (or warm claim) overrode it
+UPDATE_CONFIGS = 'chad_update_configs'
+# Sorted sets of deploys in progress (globally and per user, keyed by time of admission) and of deploys waiting to
+# start (keyed by time of arrival)
+DEPLOYS = 'chad_deploys'
+DEPLOYS_WAITING = 'chad_deploys_waiting'
+# Admits a deploy if the limits allow it (see `ChallengeManager._admission_check()`). Returns 0 if it was admitted (or
+# could be, with no token) or which limit it's held up by.
+ADMIT_SCRIPT = """
+local token, arrival, now = ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3])
+local deploy_ttl, wait_ttl = tonumber(ARGV[4]), tonumber(ARGV[5])
+local max_deploys, max_user_deploys = tonumber(ARGV[6]), tonumber(ARGV[7])
+local room, user_room = tonumber(ARGV[8]), tonumber(ARGV[9])
+
+-- Entries are only left behind by processes which died mid-deploy (or while waiting)
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - deploy_ttl)
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now - deploy_ttl)
+redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', now - wait_ttl)
+
+-- A user's own limits don't hold up anyone else, so deploys blocked by them wait out of line
+local user_deploys = redis.call('ZCARD', KEYS[2])
+local user_limited = 0
+if max_user_deploys > 0 and user_deploys >= max_user_deploys then
+    user_limited = 1
+elseif user_room >= 0 and user_deploys >= user_room then
+    user_limited = 2
+end
+if user_limited > 0 then
+    if token ~= '' then
+        redis.call('ZREM', KEYS[3], token)
+    end
+    return user_limited
+end
+
+-- Deploys ahead in line are counted as well, since they'll (most likely) become instances
+local ahead
+if token == '' then
+    ahead = redis.call('ZCARD', KEYS[3])
+else
+    -- Back in its original place if it was taken out of line (or dropped as stale)
+    redis.call('ZADD', KEYS[3], 'NX', arrival, token)
+    redis.call('EXPIRE', KEYS[3], wait_ttl)
+    ahead = redis.call('ZRANK', KEYS[3], token)
+end
+local deploys = redis.call('ZCARD', KEYS[1]) + ahead
+if max_deploys > 0 and deploys >= max_deploys then
+    return 3
+end
+if room >= 0 and deploys >= room then
+    return 4
+end
+if token == '' then
+    return 0
+end
+
+redis.call('ZREM', KEYS[3], token)
+for i = 1, 2 do
+    redis.call('ZADD', KEYS[i], now, token)
+    redis.call('EXPIRE', KEYS[i], deploy_ttl)
+end
+return 0
+"""
+
 def stack_name(u, c):
     return f'chad_{u}_{c}'
 
@@ -28,109 +117,412 @@ class InstanceExistsError(ChallengeError):
     pass
 class InstanceNotFoundError(ChallengeError):
     pass
+class ResetTimeoutError(ChallengeError):
+    pass
+class InstancePoolError(ChallengeError):
+    pass
+class PrepullTimeoutError(ChallengeError):
+    pass
+class FlightError(ChallengeError):
+    "An operation failed in another process (with an error that can't be passed on as-is)"
+    pass
+class CapacityError(ChallengeError):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+# Errors which are passed on as-is to callers sharing the outcome of an operation
+FLIGHT_ERRORS = {e.__name__: e for e in (InstanceExistsError, InstanceNotFoundError, ResetTimeoutError,
+    InstancePoolError, util.FlagLengthError)}
 
 class ChallengeManager:
     def __init__(self, docker_, pki_: pki.PKI, stacks, redis, salt, docker_registry='example.com', flag_prefix='CTF',
-        instance_timeout=60, gateway_timeout=120, gateway_image='chad-gateway',
-        gateway_domain='chad-gw.sys.hacktrinity.org', traefik_network='traefik',
-        network_plugin='weaveworks/net-plugin:latest_release'):
+        flag_table='/var/lib/chad/flags.bin', flag_ttl=30 * 86400, flag_attempts=10, instance_timeout=60,
+        gateway_timeout=120, gateway_image='chad-gateway', gateway_domain='chad-gw.sys.hacktrinity.org',
+        traefik_network='traefik', network_plugin='weaveworks/net-plugin:latest_release', gateway_pool=(),
+        gateway_pool_concurrency=4, cleanup_concurrency=8, retry_delay=10, shard_grace=30, claim_ttl=300,
+        template_cache_size=128, reset_concurrency=8, reset_timeout=60, reset_poll_interval=0.5,
+        instance_pool_concurrency=4, prepull_timeout=600, prepull_poll_interval=2, max_instances=0,
+        max_node_instances=0, max_user_instances=0, max_deploys=0, max_user_deploys=0, admission_wait=0,
+        admission_poll_interval=0.5, admission_retry_after=5, deploy_ttl=600, flight_ttl=600, flight_result_ttl=30):
         self.ids = hashids.Hashids(salt, min_length=10)
-        self.flags = util.FlagGenerator(prefix=flag_prefix)
+        self.flags = util.FlagGenerator(prefix=flag_prefix, table=flag_table)
+        self.flag_ttl = flag_ttl
+        self.flag_attempts = flag_attempts
 
         self.docker = docker_
         self.pki = pki_
         self.stacks = stacks
         self.redis = redis
+        self._admit = redis.register_script(ADMIT_SCRIPT)
+        self._release = redis.register_script(RELEASE_SCRIPT)
         self.instance_timeout = instance_timeout
         self.gateway_timeout = gateway_timeout
         self.docker_registry = docker_registry
         self.gateway_image = gateway_image
         self.gateway_domain = gateway_domain
-        self.traefik_network = self.docker.networks.get(traefik_network)
+        self.traefik_network_name = traefik_network
+        self._traefik_network = None
         self.network_plugin = network_plugin
+        self.gateway_pool = set(gateway_pool)
+        self.gateway_pool_concurrency = gateway_pool_concurrency
+        self.cleanup_concurrency = cleanup_concurrency
+        self.retry_delay = retry_delay
+        self.shard_grace = shard_grace
+        self.claim_ttl = claim_ttl
+        # Compiled stack templates, keyed by challenge ID and stack hash (least recently used first)
+        self.templates = OrderedDict()
+        self.template_cache_size = template_cache_size
+        self.reset_concurrency = reset_concurrency
+        self.reset_timeout = reset_timeout
+        self.reset_poll_interval = reset_poll_interval
+        self.instance_pool_concurrency = instance_pool_concurrency
+        self.prepull_timeout = prepull_timeout
+        self.prepull_poll_interval = prepull_poll_interval
+        self.max_instances = max_instances
+        self.max_node_instances = max_node_instances
+        self.max_user_instances = max_user_instances
+        self.max_deploys = max_deploys
+        self.max_user_deploys = max_user_deploys
+        self.admission_wait = admission_wait
+        self.admission_poll_interval = admission_poll_interval
+        self.admission_retry_after = admission_retry_after
+        self.deploy_ttl = deploy_ttl
+        self._nodes = (0, 0)
+        self._instances = (0, frozenset())
+        self.flight_ttl = flight_ttl
+        self.flight_result_ttl = flight_result_ttl
 
-    def cleanup(self, logger=None):
-        now = int(time.time())
+    @property
+    def traefik_network(self):
+        # Looked up on first use, so that processes which never create gateways (e.g. provisioning) don't need to
+        if self._traefik_network is None:
+            self._traefik_network = self.docker.networks.get(self.traefik_network_name)
+        return self._traefik_network
 
-        for stack in filter(lambda s: s.startswith('chad_'), self.stacks.ls()):
-            key = f'{stack}_last_ping'
-            last = self.redis.get(key)
-            if last is None:
-                # Give a chance for an untracked instance to be pinged
-                self.redis.set(key, now)
-                continue
+    def _shard_filter(self, expired, timeout, now, shard):
+        if shard is None:
+            return list(map(lambda e: e[0], expired))
 
-            last = int(last)
-            if now - last > self.instance_timeout:
-                if logger:
-                    logger.info('cleaning up defunct challenge instance stack %s', stack)
-                self.stacks.rm(stack)
-                self.redis.delete(key)
+        index, count = shard
+        # Entries belonging to another replica are only taken over once that replica has had a fair chance to
+        # deal with them (e.g. it may have died)
+        overdue = now - timeout - self.shard_grace
+        return [name for name, last in expired
+            if zlib.crc32(name.encode('utf-8')) % count == index or last < overdue]
+
+    def _claim(self, names):
+        if not names:
+            return []
+
+        pipe = self.redis.pipeline(transaction=False)
+        for name in names:
+            pipe.set(f'{CLEANUP_CLAIM_PREFIX}{name}', 1, nx=True, ex=self.claim_ttl)
+        return [name for name, claimed in zip(names, pipe.execute()) if claimed]
 
-        gateways = self.docker.services.list(filters={
+    def track(self, now=None):
+        """
+        Lists instance stacks and gateways, starting the timeout of any which aren't being tracked yet (e.g. ones
+        created outside of CHAD) so they get a chance to be pinged
+        """
+        now = int(time.time()) if now is None else now
+
+        stacks = set(filter(lambda s: s.startswith('chad_') and not s.startswith(POOL_STACK_PREFIX), self.stacks.ls()))
+        gateways = set(map(lambda s: s['Spec']['Name'], self.docker.api.services(filters={
             'label': [
                 f'{LABEL_PREFIX}.is_gateway=true'
             ]
-        })
-        for service in gateways:
-            user_id = int(GATEWAY_SERVICE_REGEX.match(service.name).group(1))
-
-            key = f'{service.name}_last_ping'
-            last = self.redis.get(key)
-            if last is None:
-                # Give a chance for an untracked gateway to be pinged
-                self.redis.set(key, now)
-                continue
+        })))
 
-            last = int(last)
-            if now - last > self.gateway_timeout:
-                try:
-                    self.ensure_gateway_gone(user_id)
+        pipe = self.redis.pipeline(transaction=False)
+        if stacks:
+            pipe.zadd(INSTANCE_PINGS, dict.fromkeys(stacks, now), nx=True)
+        if gateways:
+            pipe.zadd(GATEWAY_PINGS, dict.fromkeys(gateways, now), nx=True)
+        pipe.execute()
+        return stacks, gateways
+
+    def cleanup(self, logger=None, shard=None):
+        now = int(time.time())
+        stacks, gateways = self.track(now)
 
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zrangebyscore(INSTANCE_PINGS, '-inf', f'({now - self.instance_timeout}', withscores=True)
+        pipe.zrangebyscore(GATEWAY_PINGS, '-inf', f'({now - self.gateway_timeout}', withscores=True)
+        expired_stacks, expired_gateways = map(
+            lambda entries: list(map(lambda e: (e[0].decode('utf-8'), int(e[1])), entries)), pipe.execute()[-2:])
+
+        # When several replicas run cleanup, each one takes its own shard of the expired entries. Claims make sure
+        # no entry is ever worked on by two replicas at once (e.g. while replicas are joining or leaving).
+        expired_stacks = self._claim(self._shard_filter(expired_stacks, self.instance_timeout, now, shard))
+        expired_gateways = self._claim(self._shard_filter(expired_gateways, self.gateway_timeout, now, shard))
+
+        removed_stacks = []
+        failed_stacks = []
+        def rm_stack(stack):
+            if logger:
+                logger.info('cleaning up defunct challenge instance stack %s', stack)
+            try:
+                self._rm_stack(stack)
+                removed_stacks.append(stack)
+            except stack_.StackError as ex:
+                failed_stacks.append(stack)
+                if logger:
+                    logger.error('failed to clean up challenge instance stack %s: %s', stack, ex)
+        pool = gevent.pool.Pool(self.cleanup_concurrency)
+        pool.map(rm_stack, filter(lambda s: s in stacks, expired_stacks))
+        # Instances that have just been removed no longer hold up their user's gateway
+        remaining = stacks.difference(removed_stacks)
+
+        gone = list(filter(lambda s: s not in gateways, expired_gateways))
+        held = []
+        failed_gateways = []
+        pool_users = self.gateway_pool_users()
+        def rm_gateway(service_name):
+            user_id = int(GATEWAY_SERVICE_REGEX.match(service_name).group(1))
+            try:
+                if user_id in pool_users:
+                    self.park_gateway(user_id, stacks=remaining, idle_since=now - self.gateway_timeout)
+                    if logger:
+                        logger.info('parked defunct gateway for user %d', user_id)
+                else:
+                    self.ensure_gateway_gone(user_id, stacks=remaining, idle_since=now - self.gateway_timeout)
                     if logger:
                         logger.info('cleaned up defunct gateway for user %d', user_id)
-                    self.redis.delete(key)
-                except InstanceExistsError:
+                gone.append(service_name)
+            except InstanceExistsError:
+                held.append(service_name)
+                if logger:
                     logger.debug('NOT cleaning up defunct gateway for user %d (instances still running)', user_id)
+            except (docker.errors.APIError, FlightError) as ex:
+                failed_gateways.append(service_name)
+                if logger:
+                    logger.error('failed to clean up gateway for user %d: %s', user_id, ex)
+        pool.map(rm_gateway, filter(lambda s: s in gateways, expired_gateways))
+
+        pipe = self.redis.pipeline(transaction=False)
+        # Stacks which have disappeared by themselves are forgotten too
+        forgotten = removed_stacks + list(filter(lambda s: s not in stacks, expired_stacks))
+        if forgotten:
+            pipe.zrem(INSTANCE_PINGS, *forgotten)
+        if gone:
+            pipe.zrem(GATEWAY_PINGS, *gone)
+        # Reschedule anything that couldn't be removed, so it doesn't keep the next deadline in the past. A held
+        # gateway can go once its user's instances have expired, which is at most one instance timeout away.
+        self._reschedule(pipe, INSTANCE_PINGS, failed_stacks, self.instance_timeout, self.retry_delay, now)
+        self._reschedule(pipe, GATEWAY_PINGS, failed_gateways, self.gateway_timeout, self.retry_delay, now)
+        self._reschedule(pipe, GATEWAY_PINGS, held, self.gateway_timeout, self.instance_timeout, now)
+        claims = list(map(lambda n: f'{CLEANUP_CLAIM_PREFIX}{n}', expired_stacks + expired_gateways))
+        if claims:
+            pipe.delete(*claims)
+        pipe.execute()
+
+        return len(removed_stacks), len(gone)
+
+    @staticmethod
+    def _reschedule(pipe, key, names, timeout, delay, now):
+        if names:
+            # Score such that the entry expires `delay` seconds from now
+            pipe.zadd(key, dict.fromkeys(names, now + delay - timeout - 1), xx=True)
+
+    def _next_expiry(self, key, timeout, now, shard, batch=100):
+        if shard is None:
+            oldest = self.redis.zrange(key, 0, 0, withscores=True)
+            # Anything pinged or created from now on can't expire before a full timeout has passed, so an empty set
+            # doesn't need to be checked before then
+            return (int(oldest[0][1]) if oldest else now) + timeout
+
+        # The deadline is whichever comes first out of this shard's oldest entry expiring and another shard's oldest
+        # entry becoming overdue (so that it's taken over)
+        index, count = shard
+        takeover = None
+        start = 0
+        while True:
+            entries = self.redis.zrange(key, start, start + batch - 1, withscores=True)
+            for name, last in entries:
+                deadline = int(last) + timeout
+                if zlib.crc32(name) % count == index:
+                    return deadline if takeover is None else min(deadline, takeover)
+                if takeover is None:
+                    takeover = deadline + self.shard_grace
+                elif deadline >= takeover:
+                    return takeover
+            if len(entries) < batch:
+                return now + timeout if takeover is None else min(now + timeout, takeover)
+            start += batch
+
+    def next_expiry(self, shard=None):
+        now = int(time.time())
+        return min(self._next_expiry(INSTANCE_PINGS, self.instance_timeout, now, shard),
+            self._next_expiry(GATEWAY_PINGS, self.gateway_timeout, now, shard)) + 1
+
+    def _check_no_instances(self, user_id, stacks=None, idle_since=None):
+        regex = re.compile(f'chad_{user_id}_\\d+$')
+        for stack in stacks if stacks is not None else self.stacks.ls():
+            if regex.match(stack):
+                raise InstanceExistsError(f'Cannot remove gateway for user {user_id}, challenge instances are running')
+
+        # `stacks` can be out of date by the time the gateway's lock is taken, but an instance which was being created
+        # in the meantime will have brought the gateway up (and so pinged it) first
+        if idle_since is not None:
+            last_ping = self.redis.zscore(GATEWAY_PINGS, f'chad_{user_id}_gw')
+            if last_ping is not None and last_ping >= idle_since:
+                raise InstanceExistsError(f'Cannot remove gateway for user {user_id}, it has just been brought up')
+
+    def _single_flight(self, key, op, fn):
+        """
+        Runs `fn` once nothing else (in any process) is operating on `key`. If another caller is already running the
+        same `op` on it, its outcome (result or error) is shared instead.
+        """
+        lock_key = f'{FLIGHT_PREFIX}{key}'
+        while True:
+            token = uuid.uuid4().hex
+            if self.redis.set(lock_key, token, nx=True, ex=self.flight_ttl):
+                break
+
+            leader = self.redis.get(lock_key)
+            if leader is None:
+                continue
+            # Popping and pushing back onto the same list lets every waiter block on the outcome without consuming it
+            result_key = f'{lock_key}_{leader.decode("utf-8")}'
+            outcome = self.redis.brpoplpush(result_key, result_key, timeout=self.flight_ttl)
+            if outcome is None:
+                # The lock expired without an outcome (e.g. the process running the operation died)
+                continue
+
+            outcome = json.loads(outcome)
+            if outcome['op'] != op:
+                # Something else was happening to it (e.g. a delete during a create), so run after it instead
+                continue
+            if 'error' not in outcome:
+                return outcome['result']
+            if outcome['error_type'] == CapacityError.__name__:
+                raise CapacityError(outcome['error'], outcome['retry_after'])
+            raise FLIGHT_ERRORS.get(outcome['error_type'], FlightError)(outcome['error'])
+
+        outcome = {'op': op, 'error': 'Operation was interrupted', 'error_type': FlightError.__name__}
+        try:
+            result = fn()
+            outcome = {'op': op, 'result': result}
+            return result
+        except Exception as ex:
+            outcome = {
+                'op': op,
+                'error': str(ex),
+                'error_type': type(ex).__name__,
+                'retry_after': getattr(ex, 'retry_after', None)
+            }
+            raise
+        finally:
+            # Only released if it hasn't expired and been taken by someone else in the meantime. This happens before the
+            # outcome is published, so waiters for a different operation can take the lock as soon as they see it.
+            self._release(keys=[lock_key], args=[token])
+            result_key = f'{lock_key}_{token}'
+            pipe = self.redis.pipeline()
+            pipe.lpush(result_key, json.dumps(outcome))
+            pipe.expire(result_key, self.flight_result_ttl)
+            pipe.execute()
+
+    def _gateway_labels(self, user_id):
+        return {
+            f'{LABEL_PREFIX}.is_gateway': 'true',
+            'traefik.enable': 'true',
+            f'traefik.tcp.routers.chad_{user_id}_gw.rule':
+                f'HostSNI(`CONNECT:{user_id}.{self.gateway_domain}:1194`)',
+            f'traefik.tcp.routers.chad_{user_id}.entrypoints': 'http',
+            f'traefik.tcp.services.chad_{user_id}.loadbalancer.server.port': '1194'
+        }
+
+    def _create_gateway(self, user_id, standby=False):
+        net_name = f'chad_{user_id}'
+        try:
+            net = self.docker.networks.get(net_name)
+        except docker.errors.NotFound:
+            self.docker.networks.create(net_name, driver=self.network_plugin)
+            net = self.docker.networks.get(net_name)
+
+        conf_secret_name = f'chad_{user_id}_gwconf'
+        try:
+            conf_secret = self.docker.secrets.get(conf_secret_name)
+        except docker.errors.NotFound:
+            conf = self.pki.generate_server_ovpn(user_id, POOL_START, POOL_END, NETWORK)
+            self.docker.secrets.create(name=conf_secret_name, data=conf)
+            conf_secret = self.docker.secrets.get(conf_secret_name)
+
+        if standby:
+            # A standby gateway has everything in place but runs no tasks and isn't routed by Traefik
+            mode = docker.types.ServiceMode('replicated', 0)
+            labels = {f'{LABEL_PREFIX}.is_gateway': 'standby'}
+        else:
+            mode = docker.types.ServiceMode('replicated', 1)
+            labels = self._gateway_labels(user_id)
+
+        self.docker.services.create(self.gateway_image, name=f'chad_{user_id}_gw', env=['__CAP_ADD=NET_ADMIN'],
+            labels=labels, mode=mode, networks=[net.id, self.traefik_network.id],
+            secrets=[docker.types.SecretReference(conf_secret.id, conf_secret_name, filename='server.conf',
+            mode=0o440)])
 
     def ensure_gateway_up(self, user_id):
+        self._single_flight(f'gateway_{user_id}', 'ensure_up', lambda: self._ensure_gateway_up(user_id))
+
+    def _ensure_gateway_up(self, user_id):
         service_name = f'chad_{user_id}_gw'
         try:
-            self.docker.services.get(service_name)
-            self.redis.set(f'chad_{user_id}_gw_last_ping', int(time.time()))
+            service = self.docker.services.get(service_name)
+            if service.attrs['Spec']['Labels'].get(f'{LABEL_PREFIX}.is_gateway') == 'standby':
+                service.update(mode=docker.types.ServiceMode('replicated', 1), labels=self._gateway_labels(user_id))
         except docker.errors.NotFound:
-            net_name = f'chad_{user_id}'
-            try:
-                net = self.docker.networks.get(net_name)
-            except docker.errors.NotFound:
-                self.docker.networks.create(net_name, driver=self.network_plugin)
-                net = self.docker.networks.get(net_name)
+            self._create_gateway(user_id)
+        self.redis.zadd(GATEWAY_PINGS, {f'chad_{user_id}_gw': int(time.time())})
+
+    def gateway_pool_users(self):
+        members = self.redis.smembers('chad_gateway_pool')
+        return self.gateway_pool | set(map(int, members))
+
+    def add_gateway_pool_users(self, user_ids):
+        if user_ids:
+            self.redis.sadd('chad_gateway_pool', *user_ids)
+
+    def park_gateway(self, user_id, stacks=None, idle_since=None):
+        self._single_flight(f'gateway_{user_id}', 'park', lambda: self._park_gateway(user_id, stacks, idle_since))
+
+    def _park_gateway(self, user_id, stacks, idle_since):
+        self._check_no_instances(user_id, stacks, idle_since)
+
+        try:
+            self.docker.services.get(f'chad_{user_id}_gw').update(mode=docker.types.ServiceMode('replicated', 0),
+                labels={f'{LABEL_PREFIX}.is_gateway': 'standby'})
+        except docker.errors.NotFound:
+            pass
 
-            conf_secret_name = f'chad_{user_id}_gwconf'
+    def fill_gateway_pool(self, logger=None):
+        users = self.gateway_pool_users()
+        if not users:
+            return
+
+        existing = set(map(lambda s: s['Spec']['Name'], self.docker.api.services(filters={
+            'label': [f'{LABEL_PREFIX}.is_gateway']
+        })))
+        missing = sorted(filter(lambda u: f'chad_{u}_gw' not in existing, users))
+        if not missing:
+            return
+
+        if logger:
+            logger.info('preparing %d standby gateways', len(missing))
+        def prepare(user_id):
             try:
-                conf_secret = self.docker.secrets.get(conf_secret_name)
-            except docker.errors.NotFound:
-                conf = self.pki.generate_server_ovpn(user_id, POOL_START, POOL_END, NETWORK)
-                self.docker.secrets.create(name=conf_secret_name, data=conf)
-                conf_secret = self.docker.secrets.get(conf_secret_name)
-
-            self.docker.services.create(self.gateway_image, name=service_name, env=['__CAP_ADD=NET_ADMIN'], labels={
-                    f'{LABEL_PREFIX}.is_gateway': 'true',
-                    'traefik.enable': 'true',
-                    f'traefik.tcp.routers.chad_{user_id}_gw.rule':
-                        f'HostSNI(`CONNECT:{user_id}.{self.gateway_domain}:1194`)',
-                    f'traefik.tcp.routers.chad_{user_id}.entrypoints': 'http',
-                    f'traefik.tcp.services.chad_{user_id}.loadbalancer.server.port': '1194'
-                }, networks=[net.id, self.traefik_network.id],
-                secrets=[docker.types.SecretReference(conf_secret.id, conf_secret_name, filename='server.conf',
-                mode=0o440)])
-            self.redis.set(f'chad_{user_id}_gw_last_ping', int(time.time()))
-
-    def ensure_gateway_gone(self, user_id):
-        regex = re.compile(f'chad_{user_id}_\\d+$')
-        for stack in self.stacks.ls():
-            if regex.match(stack):
-                raise InstanceExistsError(f'Cannot destroy gateway for user {user_id}, challenge instances are running')
+                self._create_gateway(user_id, standby=True)
+            except (docker.errors.APIError, pki.EasyRSAError) as ex:
+                if logger:
+                    logger.warning('failed to prepare standby gateway for user %d: %s', user_id, ex)
+        gevent.pool.Pool(self.gateway_pool_concurrency).map(prepare, missing)
+
+    def ensure_gateway_gone(self, user_id, stacks=None, idle_since=None):
+        self._single_flight(f'gateway_{user_id}', 'ensure_gone',
+            lambda: self._ensure_gateway_gone(user_id, stacks, idle_since))
+
+    def _ensure_gateway_gone(self, user_id, stacks, idle_since):
+        self._check_no_instances(user_id, stacks, idle_since)
 
         try:
             self.docker.services.get(f'chad_{user_id}_gw').remove()
@@ -146,63 +538,570 @@ class ChallengeManager:
             self.docker.networks.get(f'chad_{user_id}').remove()
         except docker.errors.NotFound:
             pass
+        self.redis.zrem(GATEWAY_PINGS, f'chad_{user_id}_gw')
+
+    def generate_flags(self, count, length=None):
+        "Generates `count` flags, none of which have been generated before"
+        flags = []
+        for _ in range(self.flag_attempts):
+            batch = self.flags.next_flags(count - len(flags), length)
+            pipe = self.redis.pipeline(transaction=False)
+            for flag in batch:
+                pipe.sadd(FLAGS, flag)
+            pipe.expire(FLAGS, self.flag_ttl)
+            # Anything which collided (including within the batch) just gets drawn again
+            flags.extend(map(lambda r: r[0], filter(lambda r: r[1], zip(batch, pipe.execute()[:-1]))))
+            if len(flags) == count:
+                return flags
+
+        # Most likely (nearly) every possible flag of this length has been used up
+        raise util.FlagLengthError(f'Only {len(flags)} of {count} flags could be generated without repeating ' +
+            'previous ones, try another length')
+
+    def _template(self, challenge_id, stack):
+        # Always derived from the stack itself, since the hash also decides which warm instances can be claimed
+        stack_hash = hashlib.sha1(json.dumps(stack, sort_keys=True).encode('utf-8')).hexdigest()
+
+        key = (challenge_id, stack_hash)
+        template = self.templates.get(key)
+        if template is None:
+            template = self.templates[key] = stack_.StackTemplate(stack)
+            while len(self.templates) > self.template_cache_size:
+                self.templates.popitem(last=False)
+        else:
+            self.templates.move_to_end(key)
+        return stack_hash, template
+
+    def _create_flag_secret(self, name, flag):
+        "Creates the secret holding an instance's flag, returning its name and ID"
+        # Labelled as part of the stack so that removing the stack removes it too
+        secret_name = f'{name}_flag'
+        labels = {stack_.NAMESPACE_LABEL: name}
+        data = f'{flag}\n'.encode('ascii')
+        try:
+            return secret_name, self.docker.secrets.create(name=secret_name, data=data, labels=labels).id
+        except docker.errors.APIError as ex:
+            if ex.status_code != 409:
+                raise
+
+        # Left over from an instance which never fully deployed
+        try:
+            self.docker.api.remove_secret(secret_name)
+        except docker.errors.NotFound:
+            pass
+        except docker.errors.APIError:
+            # Still referenced by services of that instance, which cleanup will remove (along with the secret)
+            secret_name = f'{name}_flag_{uuid.uuid4().hex[:8]}'
+        return secret_name, self.docker.secrets.create(name=secret_name, data=data, labels=labels).id
+
+    def _rm_stack(self, name):
+        self.stacks.rm(name)
+
+        # Networks belonging to an instance that came from the warm pool are still labelled with the original stack
+        warm = self.redis.hget(INSTANCE_POOL_CLAIMED, name)
+        if warm is not None:
+            try:
+                self.stacks.rm(warm.decode('utf-8'))
+                self.redis.hdel(INSTANCE_POOL_CLAIMED, name)
+            except stack_.StackError:
+                # Most likely its networks are still in use by tasks which are shutting down, so refilling the pool
+                # takes care of them later
+                pass
+
+    @staticmethod
+    def _challenge_aliases(spec):
+        "Finds the services which are attached to the challenge network, along with their aliases on it"
+        aliases = {}
+        for service_name, service in spec.get('services', {}).items():
+            networks = service.get('networks') or []
+            if 'challenge' not in networks:
+                continue
+
+            aliases[service_name] = [service_name]
+            if isinstance(networks, dict) and networks['challenge']:
+                aliases[service_name] += networks['challenge'].get('aliases', [])
+        return aliases
+
+    def set_instance_pool(self, challenge_id, stack, service, size=None):
+        """
+        Sets the number of warm (pre-deployed) instances to keep for a challenge. A size of `None` only updates the
+        stack of an existing pool.
+        """
+        stack_hash, template = self._template(challenge_id, stack)
+        if size is None:
+            current = self.redis.hget(INSTANCE_POOL_SPECS, challenge_id)
+            if current is None:
+                return
+            size = json.loads(current)['size']
+
+        if not size:
+            self.redis.hdel(INSTANCE_POOL_SPECS, challenge_id)
+            return
+        if 'chad_id' in template.placeholders:
+            raise InstancePoolError('Stacks which use $chad_id depend on the user and so cannot be pre-deployed')
+
+        self.redis.hset(INSTANCE_POOL_SPECS, challenge_id, json.dumps({
+            'stack': stack,
+            'stack_hash': stack_hash,
+            'service': service,
+            'size': size
+        }))
+
+    def instance_pool(self):
+        specs = self.redis.hgetall(INSTANCE_POOL_SPECS)
+        pipe = self.redis.pipeline(transaction=False)
+        for challenge_id, spec in specs.items():
+            pipe.scard(f'{INSTANCE_POOL_PREFIX}{challenge_id.decode("utf-8")}_{json.loads(spec)["stack_hash"]}')
+        return {int(c): {'size': json.loads(s)['size'], 'warm': n} for (c, s), n in zip(specs.items(), pipe.execute())}
+
+    def _deploy_warm(self, challenge_id, stack_hash, template):
+        name = f'{POOL_STACK_PREFIX}{challenge_id}_{uuid.uuid4().hex[:12]}'
+        stack = template.render({'chad_docker_registry': self.docker_registry})
+
+        # The challenge network (and the flag) is only attached once the instance has been claimed by a user
+        services = {}
+        for service_name, service in stack.get('services', {}).items():
+            networks = service.get('networks')
+            if networks and 'challenge' in networks:
+                if isinstance(networks, dict):
+                    service = {**service, 'networks': {k: v for k, v in networks.items() if k != 'challenge'}}
+                else:
+                    service = {**service, 'networks': [n for n in networks if n != 'challenge']}
+            services[service_name] = service
+        stack['services'] = services
+        if 'challenge' in stack.get('networks', {}):
+            stack['networks'] = {k: v for k, v in stack['networks'].items() if k != 'challenge'}
+
+        self.stacks.deploy(name, stack, registry_auth=True)
+        pool_key = f'{INSTANCE_POOL_PREFIX}{challenge_id}_{stack_hash}'
+        pipe = self.redis.pipeline()
+        pipe.hset(INSTANCE_POOL_STACKS, name, pool_key)
+        pipe.sadd(pool_key, name)
+        pipe.execute()
+        return name
+
+    def fill_instance_pool(self, logger=None):
+        specs = {int(c): json.loads(s) for c, s in self.redis.hgetall(INSTANCE_POOL_SPECS).items()}
+        current = {f'{INSTANCE_POOL_PREFIX}{c}_{s["stack_hash"]}' for c, s in specs.items()}
+        stacks = set(self.stacks.ls())
+
+        # Retire warm stacks which are gone or no longer wanted (e.g. the challenge's stack changed). Whoever takes a
+        # stack out of its set owns it, so this can't race with an instance being claimed.
+        retired = []
+        for name, pool_key in self.redis.hgetall(INSTANCE_POOL_STACKS).items():
+            name, pool_key = name.decode('utf-8'), pool_key.decode('utf-8')
+            if (name not in stacks or pool_key not in current) and self.redis.srem(pool_key, name):
+                retired.append(name)
+                self.redis.hdel(INSTANCE_POOL_STACKS, name)
+        # Remainders (i.e. networks) of claimed instances which couldn't be removed along with the instance
+        leftovers = list(filter(lambda l: l[0] not in stacks, map(
+            lambda l: (l[0].decode('utf-8'), l[1].decode('utf-8')), self.redis.hgetall(INSTANCE_POOL_CLAIMED).items())))
+
+        def retire(name, claimed=None):
+            try:
+                self.stacks.rm(name)
+                if claimed is not None:
+                    self.redis.hdel(INSTANCE_POOL_CLAIMED, claimed)
+            except stack_.StackError as ex:
+                if logger:
+                    logger.warning('failed to remove warm instance stack %s: %s', name, ex)
+        pool = gevent.pool.Pool(self.instance_pool_concurrency)
+        pool.map(retire, filter(lambda n: n in stacks, retired))
+        pool.map(lambda l: retire(l[1], l[0]), leftovers)
+
+        pipe = self.redis.pipeline(transaction=False)
+        for challenge_id, spec in specs.items():
+            pipe.scard(f'{INSTANCE_POOL_PREFIX}{challenge_id}_{spec["stack_hash"]}')
+        missing = []
+        for (challenge_id, spec), warm in zip(specs.items(), pipe.execute()):
+            missing += [challenge_id] * max(spec['size'] - warm, 0)
+        if not missing:
+            return
+
+        if logger:
+            logger.info('deploying %d warm challenge instances', len(missing))
+        def prepare(challenge_id):
+            spec = specs[challenge_id]
+            try:
+                self._deploy_warm(challenge_id, *self._template(challenge_id, spec['stack']))
+            except stack_.StackError as ex:
+                if logger:
+                    logger.warning('failed to deploy warm instance of challenge %d: %s', challenge_id, ex)
+        pool.map(prepare, missing)
+
+    def _claim_warm(self, user_id, challenge_id, stack_hash, template, service, flag):
+        """
+        Turns a warm instance of a challenge into the given user's instance. Returns `False` if there were none.
+
+        The user's network and flag secret can only be attached now, which replaces the tasks of the services that get
+        them. Those still have to start, but their images are already on the node and the rest of the stack (as well as
+        the stack's own networks and volumes) is left running.
+        """
+        while True:
+            warm = self.redis.spop(f'{INSTANCE_POOL_PREFIX}{challenge_id}_{stack_hash}')
+            if warm is None:
+                return False
+            warm = warm.decode('utf-8')
+            self.redis.hdel(INSTANCE_POOL_STACKS, warm)
+
+            services = self.docker.services.list(filters={'label': f'{stack_.NAMESPACE_LABEL}={warm}'})
+            if services:
+                break
+
+        name = stack_name(user_id, challenge_id)
+        self.redis.hset(INSTANCE_POOL_CLAIMED, name, warm)
+        network = self.docker.networks.get(f'chad_{user_id}')
+        secret_name, secret_id = self._create_flag_secret(name, flag) if flag else (None, None)
+        aliases = self._challenge_aliases(template.spec)
+
+        def claim(service_):
+            spec = service_.attrs['Spec']
+            service_name = spec['Name'][len(warm) + 1:]
+            kwargs = {'labels': {**spec.get('Labels', {}), stack_.NAMESPACE_LABEL: name}}
+            if service_name in aliases:
+                kwargs['networks'] = list(map(
+                    lambda n: docker.types.NetworkAttachmentConfig(n['Target'], aliases=n.get('Aliases')),
+                    spec['TaskTemplate'].get('Networks', []))) + \
+                    [docker.types.NetworkAttachmentConfig(network.id, aliases=aliases[service_name])]
+            if secret_id is not None and service_name == service:
+                kwargs['secrets'] = list(map(
+                    lambda r: docker.types.SecretReference(r['SecretID'], r['SecretName'], filename=r['File']['Name'],
+                        uid=r['File']['UID'], gid=r['File']['GID'], mode=r['File']['Mode']),
+                    spec['TaskTemplate']['ContainerSpec'].get('Secrets', []))) + \
+                    [docker.types.SecretReference(secret_id, secret_name, filename='flag.txt', mode=0o440)]
+            self._update_all_at_once(service_, **kwargs)
+        gevent.pool.Pool(self.instance_pool_concurrency).map(claim, services)
+
+        self.stacks.renamed(warm, name)
+        return True
+
+    def _instance_limit(self):
+        limit = self.max_instances or None
+        if self.max_node_instances:
+            checked, nodes = self._nodes
+            if time.monotonic() - checked > 60:
+                nodes = len(list(filter(lambda n: n['Status']['State'] == 'ready' and
+                    n['Spec']['Availability'] == 'active', self.docker.api.nodes())))
+                self._nodes = (time.monotonic(), nodes)
+            node_limit = nodes * self.max_node_instances
+            limit = node_limit if limit is None else min(limit, node_limit)
+        return limit
+
+    def _instance_stacks(self):
+        # Outside the API server there's no inventory, so this is a full listing; admission polls it too often for that
+        checked, instances = self._instances
+        if time.monotonic() - checked > 2:
+            instances = frozenset(filter(lambda s: s.startswith('chad_') and not s.startswith(POOL_STACK_PREFIX),
+                self.stacks.ls()))
+            self._instances = (time.monotonic(), instances)
+        return instances
+
+    def _admission_limited(self):
+        return any((self.max_instances, self.max_node_instances, self.max_user_instances, self.max_deploys,
+            self.max_user_deploys))
+
+    def _admission_check(self, user_id, token='', arrival=0):
+        """
+        Admits the deploy holding `token` (`{stack name}:{unique ID}`) if it's within the limits, returning why not
+        otherwise. Without a token, only checks whether a deploy could be admitted right now.
+        """
+        prefix = f'chad_{user_id}_'
+        instances = self._instance_stacks()
+        # Admitted deploys are counted against the limits by the script, so those whose stack is already listed as an
+        # instance would otherwise be counted twice
+        deploying = set(map(lambda m: m.decode('utf-8').partition(':')[0], self.redis.zrange(DEPLOYS, 0, -1)))
+        counted = len(instances) - len(instances & deploying)
+        user_counted = len(list(filter(lambda s: s.startswith(prefix) and s not in deploying, instances)))
+
+        limit = self._instance_limit()
+        # Negative means no limit to the script, so being over it is no room at all
+        room = -1 if limit is None else max(limit - counted, 0)
+        user_room = max(self.max_user_instances - user_counted, 0) if self.max_user_instances else -1
+
+        # Anything which has been waiting longer than it could have is gone
+        wait_ttl = int(self.admission_wait) + 30
+        result = self._admit(keys=[DEPLOYS, f'{DEPLOYS}_{user_id}', DEPLOYS_WAITING], args=[
+            token, arrival, time.time(), self.deploy_ttl, wait_ttl, self.max_deploys, self.max_user_deploys, room,
+            user_room
+        ])
+        return {
+            1: f'Too many instances are being deployed for user ID {user_id}',
+            2: f'Too many instances are running for user ID {user_id}',
+            3: 'Too many instances are being deployed right now',
+            4: 'The maximum number of running instances has been reached'
+        }.get(result)
+
+    def check_capacity(self, user_id):
+        "Raises a `CapacityError` if a deploy for the given user couldn't start right now"
+        if not self._admission_limited():
+            return
+
+        reason = self._admission_check(user_id)
+        if reason is not None:
+            raise CapacityError(reason, self.admission_retry_after)
+
+    @contextlib.contextmanager
+    def _admission(self, user_id, name):
+        """
+        Waits for up to `admission_wait` seconds for a deploy to be within the limits. Deploys which are only held up
+        by the global limits are admitted in order of arrival across every process.
+        """
+        if not self._admission_limited():
+            yield
+            return
+
+        token = f'{name}:{uuid.uuid4().hex}'
+        arrival = time.time()
+        try:
+            deadline = time.monotonic() + self.admission_wait
+            while True:
+                reason = self._admission_check(user_id, token, arrival)
+                if reason is None:
+                    break
+                if time.monotonic() >= deadline:
+                    raise CapacityError(reason, self.admission_retry_after)
+                time.sleep(self.admission_poll_interval)
+
+            yield
+        finally:
+            pipe = self.redis.pipeline(transaction=False)
+            for key in (DEPLOYS, f'{DEPLOYS}_{user_id}', DEPLOYS_WAITING):
+                pipe.zrem(key, token)
+            pipe.execute()
 
     def create(self, user_id, challenge_id, stack, service, flag=True):
-        result = {'id': self.ids.encode(user_id, challenge_id)}
+        return self._single_flight(f'instance_{stack_name(user_id, challenge_id)}', 'create',
+            lambda: self._create(user_id, challenge_id, stack, service, flag))
+
+    def _create(self, user_id, challenge_id, stack, service, flag):
         name = stack_name(user_id, challenge_id)
-        if name in self.stacks.ls():
+        if self.stacks.exists(name):
             raise InstanceExistsError(f'An instance of challenge ID {challenge_id} already exists for user ID {user_id}')
 
+        with self._admission(user_id, name):
+            return self._deploy_instance(user_id, challenge_id, stack, service, flag)
+
+    def _deploy_instance(self, user_id, challenge_id, stack, service, flag):
+        result = {'id': self.ids.encode(user_id, challenge_id)}
+        name = stack_name(user_id, challenge_id)
+
         self.ensure_gateway_up(user_id)
 
-        stack_context = {
+        if flag:
+            if isinstance(flag, str):
+                result['flag'] = flag
+            elif flag is True:
+                result['flag'] = self.generate_flags(1)[0]
+            elif isinstance(flag, int):
+                result['flag'] = self.generate_flags(1, flag)[0]
+
+        stack_hash, template = self._template(challenge_id, stack)
+        if 'chad_id' not in template.placeholders:
+            self.redis.zadd(INSTANCE_PINGS, {name: int(time.time())})
+            if self._claim_warm(user_id, challenge_id, stack_hash, template, service, result.get('flag')):
+                return result
+
+        stack = template.render({
             'chad_id': result['id'],
             'chad_docker_registry': self.docker_registry
-        }
-
-        stack_template = Template(json.dumps(stack))
-        stack = json.loads(stack_template.safe_substitute(**stack_context))
+        })
 
         # Docker Swarm overlay networks don't FUCKING SUPPORT MULTICAST
-        dpath.new(stack, f'networks/challenge', {
+        stack['networks'] = {**stack.get('networks', {}), 'challenge': {
             'driver': self.network_plugin,
             'external': True,
             'name': f'chad_{user_id}'
-        })
+        }}
+        secret_name = None
         if flag:
-            if isinstance(flag, str):
-                result['flag'] = flag
-            elif flag is True:
-                result['flag'] = self.flags.next_flag()
-            elif isinstance(flag, int):
-                result['flag'] = self.flags.next_flag(flag)
-            secret_tmp = tempfile.NamedTemporaryFile('w', prefix='flag', suffix='.txt', encoding='ascii')
-            secret_tmp.write(f'{result["flag"]}\n')
-            secret_tmp.flush()
-
-            dpath.new(stack, 'secrets/flag/file', secret_tmp.name)
-            dpath.merge(stack, {'services': {service: {'secrets': [{
-                'source': 'flag',
-                'target': 'flag.txt',
-                'mode': 0o440
-            }]}}})
-
-        self.redis.set(f'{name}_last_ping', int(time.time()))
-        self.stacks.deploy(name, stack, registry_auth=True)
-        if flag:
-            secret_tmp.close()
+            secret_name, _ = self._create_flag_secret(name, result['flag'])
+
+            stack['secrets'] = {**stack.get('secrets', {}), 'flag': {'external': {'name': secret_name}}}
+            service_spec = stack['services'].get(service, {})
+            stack['services'] = {**stack['services'], service: {
+                **service_spec,
+                'secrets': [*service_spec.get('secrets', []), {
+                    'source': 'flag',
+                    'target': 'flag.txt',
+                    'mode': 0o440
+                }]
+            }}
+
+        self.redis.zadd(INSTANCE_PINGS, {name: int(time.time())})
+        try:
+            self.stacks.deploy(name, stack, registry_auth=True)
+        except stack_.StackError:
+            if secret_name is not None:
+                try:
+                    self.docker.api.remove_secret(secret_name)
+                except docker.errors.APIError:
+                    # In use by whatever part of the stack did get deployed, so it goes when the stack is cleaned up
+                    pass
+            raise
         return result
 
     def ping(self, user_id, challenge_id):
         name = stack_name(user_id, challenge_id)
-        if name not in self.stacks.ls():
+        if not self.stacks.exists(name):
             raise InstanceNotFoundError(f'An instance of challenge ID {challenge_id} does not exist for user ID {user_id}')
 
         now = int(time.time())
-        self.redis.set(f'chad_{user_id}_gw_last_ping', now)
-        self.redis.set(f'{name}_last_ping', now)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zadd(GATEWAY_PINGS, {f'chad_{user_id}_gw': now})
+        pipe.zadd(INSTANCE_PINGS, {name: now})
+        pipe.execute()
+
+    def list_instances(self, user_id):
+        "Lists a user's instances, with the status of their services and how long ago they were last pinged"
+        prefix = f'chad_{user_id}_'
+        names = sorted(filter(lambda s: s.startswith(prefix) and s[len(prefix):].isdigit(), self.stacks.ls()))
+
+        pipe = self.redis.pipeline(transaction=False)
+        for name in names:
+            pipe.zscore(INSTANCE_PINGS, name)
+        now = int(time.time())
+
+        result = {}
+        for name, last_ping in zip(names, pipe.execute()):
+            challenge_id = int(name[len(prefix):])
+            result[challenge_id] = {
+                'id': self.ids.encode(user_id, challenge_id),
+                'services': self.stacks.status(name),
+                'last_ping': None if last_ping is None else now - int(last_ping)
+            }
+        return result
+
+    def ping_many(self, instances):
+        """
+        Pings every existing instance out of `instances` (a dict of user IDs to lists of challenge IDs), along with
+        the gateways of their users, in a single write. Returns whether or not each instance exists.
+        """
+        now = int(time.time())
+        result = {}
+        instance_pings = {}
+        gateway_pings = {}
+        for user_id, challenge_ids in instances.items():
+            result[user_id] = {}
+            for challenge_id in challenge_ids:
+                name = stack_name(user_id, challenge_id)
+                result[user_id][challenge_id] = self.stacks.exists(name)
+                if result[user_id][challenge_id]:
+                    instance_pings[name] = now
+                    gateway_pings[f'chad_{user_id}_gw'] = now
+
+        if instance_pings:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.zadd(GATEWAY_PINGS, gateway_pings)
+            pipe.zadd(INSTANCE_PINGS, instance_pings)
+            pipe.execute()
+        return result
+
+    def _update_all_at_once(self, service, **kwargs):
+        """
+        Updates a service, replacing every task at once rather than with its usual (rolling) update config. The
+        original is put back by `restore_update_configs()` once the update is over.
+        """
+        # Not overwritten if an earlier override hasn't been restored yet, since the service's current config is that
+        original = service.attrs['Spec'].get('UpdateConfig', {})
+        self.redis.hsetnx(UPDATE_CONFIGS, service.id, json.dumps(original))
+        service.update(update_config=docker.types.UpdateConfig(parallelism=0, delay=0, failure_action='continue',
+            order='stop-first'), **kwargs)
+
+    def restore_update_configs(self, logger=None):
+        """
+        Puts back the update config of services which `_update_all_at_once()` overrode, once their update is over
+        """
+        for service_id, original in self.redis.hgetall(UPDATE_CONFIGS).items():
+            service_id = service_id.decode('utf-8')
+            try:
+                service = self.docker.services.get(service_id)
+                if service.attrs.get('UpdateStatus', {}).get('State') in ('updating', 'rollback_started'):
+                    continue
+                # Nothing in the task template changes, so this doesn't replace any tasks
+                service.update(update_config=json.loads(original))
+            except docker.errors.NotFound:
+                pass
+            except docker.errors.APIError as ex:
+                if logger:
+                    logger.warning('failed to restore update config of service %s: %s', service_id, ex)
+                continue
+            self.redis.hdel(UPDATE_CONFIGS, service_id)
+
+    def _wait_tasks(self, versions, timeout):
+        """
+        Waits for every service's tasks to have been replaced, with `versions` mapping service IDs to their new
+        `ForceUpdate` value and number of replicas (`None` for global services)
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            tasks = self.docker.api.tasks(filters={'service': list(versions.keys()), 'desired-state': 'running'})
+            pending = set(versions.keys())
+            for service_id, (version, replicas) in versions.items():
+                service_tasks = list(filter(lambda t, s=service_id: t['ServiceID'] == s, tasks))
+                up = list(filter(lambda t, v=version: t['Status']['State'] == 'running' and
+                    t['Spec'].get('ForceUpdate', 0) == v, service_tasks))
+                if len(up) == len(service_tasks) and len(up) >= (1 if replicas is None else replicas):
+                    pending.discard(service_id)
+            if not pending:
+                return
+
+            if time.monotonic() >= deadline:
+                raise ResetTimeoutError(f'{len(pending)} service(s) did not come back up within {timeout} seconds')
+            time.sleep(self.reset_poll_interval)
 
-    def reset(self, user_id, challenge_id):
+    def prepull(self, stack, timeout=None):
+        """
+        Pulls every image in a stack onto each node its services could be placed on, by running a global service
+        (which does nothing and never restarts) for each one. Returns the number of nodes that pulled each image.
+        """
+        # Only rendered once, so there's no point compiling (and caching) a template for every launch of it
+        spec = stack_.StackTemplate(stack).render({'chad_docker_registry': self.docker_registry})
+
+        images = set()
+        for service in spec.get('services', {}).values():
+            # Images which depend on the instance can't be resolved ahead of time
+            if 'image' in service and '$' not in service['image']:
+                constraints = service.get('deploy', {}).get('placement', {}).get('constraints', [])
+                images.add((service['image'], tuple(sorted(constraints))))
+
+        services = {}
+        try:
+            for image, constraints in images:
+                # Unique, since the same image could be being pulled for another stack at the same time
+                services[image] = self.docker.services.create(image, name=f'chad_prepull_{uuid.uuid4().hex[:12]}',
+                    command=['true'], labels={f'{LABEL_PREFIX}.prepull': image},
+                    mode=docker.types.ServiceMode('global'), constraints=list(constraints),
+                    restart_policy=docker.types.RestartPolicy(condition='none')).id
+
+            # Tasks stay in the preparing state while their node is pulling the image
+            pulling = {'new', 'pending', 'assigned', 'accepted', 'preparing', 'ready', 'starting'}
+            deadline = time.monotonic() + (timeout or self.prepull_timeout)
+            while True:
+                tasks = self.docker.api.tasks(filters={'service': list(services.values())}) if services else []
+                if not any(map(lambda t: t['Status']['State'] in pulling, tasks)) and \
+                    set(map(lambda t: t['ServiceID'], tasks)) == set(services.values()):
+                    break
+                if time.monotonic() >= deadline:
+                    raise PrepullTimeoutError(f'Images were not pulled within {timeout or self.prepull_timeout} seconds')
+                time.sleep(self.prepull_poll_interval)
+
+            # Tasks get past preparing even if they then fail to start (e.g. no `true` in the image), but not if the
+            # pull failed
+            pulled = list(filter(lambda t: 'No such image' not in t['Status'].get('Err', ''), tasks))
+            return {image: len(set(map(lambda t: t['NodeID'], filter(lambda t, s=id_: t['ServiceID'] == s, pulled))))
+                for image, id_ in services.items()}
+        finally:
+            for id_ in services.values():
+                try:
+                    self.docker.api.remove_service(id_)
+                except docker.errors.NotFound:
+                    pass
+
+    def reset(self, user_id, challenge_id, wait=False, timeout=None):
+        self._single_flight(f'instance_{stack_name(user_id, challenge_id)}', 'reset',
+            lambda: self._reset(user_id, challenge_id, wait, timeout))
+
+    def _reset(self, user_id, challenge_id, wait, timeout):
         services = self.docker.services.list(filters={
             'label': [
                 f'com.docker.stack.namespace={stack_name(user_id, challenge_id)}'
@@ -211,12 +1110,26 @@ class ChallengeManager:
         if not services:
             raise InstanceNotFoundError(f'An instance of challenge ID {challenge_id} does not exist for user ID {user_id}')
 
-        for service in services:
-            service.force_update()
+        versions = {}
+        def restart(service):
+            version = service.attrs['Spec']['TaskTemplate'].get('ForceUpdate', 0) + 1
+            mode = service.attrs['Spec']['Mode']
+            versions[service.id] = (version, mode['Replicated'].get('Replicas', 1) if 'Replicated' in mode else None)
+            self._update_all_at_once(service, force_update=version)
+        pool = gevent.pool.Pool(self.reset_concurrency)
+        pool.map(restart, services)
+
+        if wait:
+            self._wait_tasks(versions, timeout or self.reset_timeout)
 
     def delete(self, user_id, challenge_id):
+        self._single_flight(f'instance_{stack_name(user_id, challenge_id)}', 'delete',
+            lambda: self._delete(user_id, challenge_id))
+
+    def _delete(self, user_id, challenge_id):
         name = stack_name(user_id, challenge_id)
-        if name not in self.stacks.ls():
+        if not self.stacks.exists(name):
             raise InstanceNotFoundError(f'An instance of challenge ID {challenge_id} does not exist for user ID {user_id}')
 
-        self.stacks.rm(name)
+        self._rm_stack(name)
+        self.redis.zrem(INSTANCE_PINGS, name)
@@ -1,37 +1,99 @@
-import os
-import logging
-import threading
-import signal
+import time
 
-class CleanupException(Exception):
+import gevent
+
+from .util import Daemon, DaemonError
+
+class CleanupException(DaemonError):
     pass
-class Cleanup:
-    def __init__(self, challenges, interval=30):
-        self.running = False
-        self.exit = threading.Event()
+class Cleanup(Daemon):
+    error = CleanupException
 
-        self.logger = logging.getLogger('cleanup')
-        handler = logging.StreamHandler()
-        handler.setFormatter(logging.Formatter('[{asctime}] [{module}] {levelname}: {message}', style='{'))
-        self.logger.addHandler(handler)
-        self.logger.setLevel(logging.DEBUG if os.getenv('DEBUG') else logging.INFO)
+    def __init__(self, challenges, interval=300, housekeeping_interval=30, min_delay=1,
+        members_key='chad_cleanup_members'):
+        super().__init__('cleanup')
 
         self.challenges = challenges
+        self.redis = challenges.redis
         self.interval = interval
+        self.housekeeping_interval = housekeeping_interval
+        self.min_delay = min_delay
+
+        self.members_key = members_key
+        # Replicas check in every time they wake up, which is at least once per housekeeping interval
+        self.member_ttl = 2 * housekeeping_interval + 10
+        self._background = {}
+
+    def _join(self):
+        now = time.time()
+        pipe = self.redis.pipeline()
+        pipe.zadd(self.members_key, {self.id: now})
+        pipe.zremrangebyscore(self.members_key, '-inf', now - self.member_ttl)
+        pipe.zrange(self.members_key, 0, -1)
+        # Scores change every time a replica checks in, so shards are assigned in order of ID instead
+        members = sorted(map(lambda m: m.decode('utf-8'), pipe.execute()[-1]))
+        return members.index(self.id), len(members)
+
+    def cleanup(self, shard):
+        self.logger.debug('running cleanup (shard %d of %d)...', shard[0] + 1, shard[1])
+        start = time.monotonic()
+        instances, gateways = self.challenges.cleanup(self.logger, shard=shard)
+        duration = time.monotonic() - start
 
-    def run(self):
-        if self.running:
-            raise CleanupException('Already running')
+        log = self.logger.warning if duration > self.housekeeping_interval else self.logger.info
+        if instances or gateways or duration > self.housekeeping_interval:
+            log('cleanup pass took %.2fs (%d instances, %d gateways removed)', duration, instances, gateways)
+        else:
+            self.logger.debug('cleanup pass took %.2fs', duration)
 
-        self.running = True
-        signal.signal(signal.SIGINT, self.stop)
-        signal.signal(signal.SIGTERM, self.stop)
-        self.logger.info('starting up')
+    def _in_background(self, name, fn):
+        """
+        Runs `fn` in its own greenlet (unless it's still going from last time), so that however long it takes it
+        doesn't hold up cleanup passes
+        """
+        running = self._background.get(name)
+        if running is not None and not running.dead:
+            return
+
+        def run():
+            try:
+                fn(self.logger)
+            except Exception: # pylint: disable=broad-except
+                self.logger.exception('%s failed', name)
+        self._background[name] = gevent.spawn(run)
+
+    def housekeeping(self, shard):
+        # Untracked stacks and gateways start timing out from the first time they're seen
+        self.challenges.track()
+        if shard[0] == 0:
+            # Only one replica needs to look after the standby gateways and warm instances
+            self._in_background('filling the gateway pool', self.challenges.fill_gateway_pool)
+            self._in_background('filling the instance pool', self.challenges.fill_instance_pool)
+            self.challenges.restore_update_configs(self.logger)
+
+    def loop(self):
+        self.logger.info('starting up as %s', self.id)
+        last_cleanup, last_housekeeping = 0, 0
         while not self.exit.is_set():
-            self.logger.debug('running cleanup...')
-            self.challenges.cleanup(self.logger)
-            self.exit.wait(self.interval)
+            shard = self._join()
+            if time.time() - last_housekeeping >= self.housekeeping_interval:
+                self.housekeeping(shard)
+                last_housekeeping = time.time()
+
+            # Cleanup passes happen when the next instance or gateway could expire. `interval` is only a safety net.
+            if time.time() >= min(self.challenges.next_expiry(shard), last_cleanup + self.interval):
+                self.cleanup(shard)
+                last_cleanup = time.time()
+
+            wake = min(self.challenges.next_expiry(shard), last_cleanup + self.interval,
+                last_housekeeping + self.housekeeping_interval)
+            delay = max(wake - time.time(), self.min_delay)
+            self.logger.debug('next wakeup in %.1fs', delay)
+            self.exit.wait(delay)
 
+        self.redis.zrem(self.members_key, self.id)
         self.logger.info('shutting down')
-    def stop(self, _signum, _frame):
-        self.exit.set()
+        # Given a chance to finish what they're deploying, rather than leaving it half done
+        background = list(self._background.values())
+        gevent.joinall(background, timeout=self.housekeeping_interval)
+        gevent.killall(background)
@@ -0,0 +1,199 @@
+import json
+import uuid
+import time
+
+import gevent.pool
+
+from .util import Daemon, DaemonError
+
+class JobError(Exception):
+    pass
+class JobNotFoundError(JobError):
+    pass
+
+class JobQueue:
+    def __init__(self, redis, key='chad_jobs', ttl=3600, max_attempts=3, queue=None):
+        self.redis = redis
+        self.key = key
+        # Jobs can be looked up no matter which queue they're in, but each queue has its own list (and workers)
+        self.queue_key = f'{key}_{queue}' if queue else key
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+
+    def _job_key(self, id_):
+        return f'{self.key}_{id_}'
+    def _processing_key(self, worker):
+        return f'{self.queue_key}_processing_{worker}'
+    def _alive_key(self, worker):
+        return f'{self.queue_key}_alive_{worker}'
+
+    def _update(self, id_, **fields):
+        fields['updated'] = int(time.time())
+        pipe = self.redis.pipeline()
+        pipe.hmset(self._job_key(id_), fields)
+        pipe.expire(self._job_key(id_), self.ttl)
+        pipe.execute()
+
+    def submit(self, type_, **args):
+        id_ = uuid.uuid4().hex
+        now = int(time.time())
+
+        pipe = self.redis.pipeline()
+        pipe.hmset(self._job_key(id_), {
+            'type': type_,
+            'args': json.dumps(args),
+            'status': 'queued',
+            'created': now,
+            'updated': now
+        })
+        pipe.expire(self._job_key(id_), self.ttl)
+        pipe.lpush(self.queue_key, id_)
+        pipe.execute()
+        return id_
+
+    def get(self, id_):
+        job = self.redis.hgetall(self._job_key(id_))
+        if not job:
+            raise JobNotFoundError(f'Job {id_} does not exist')
+
+        job = {k.decode('utf-8'): v.decode('utf-8') for k, v in job.items()}
+        result = {
+            'id': id_,
+            'attempts': int(job.get('attempts', 0)),
+            'type': job['type'],
+            'args': json.loads(job['args']),
+            'status': job['status'],
+            'created': int(job['created']),
+            'updated': int(job['updated'])
+        }
+        if 'result' in job:
+            result['result'] = json.loads(job['result'])
+        if 'error' in job:
+            result['error'] = job['error']
+            result['error_type'] = job['error_type']
+        return result
+
+    def next(self, worker, timeout=1):
+        # Jobs stay in the worker's processing list until they're finished, so they can be recovered if it dies
+        item = self.redis.brpoplpush(self.queue_key, self._processing_key(worker), timeout=timeout)
+        if item is None:
+            return None
+        return item.decode('utf-8')
+    def finish(self, worker, id_):
+        self.redis.lrem(self._processing_key(worker), 1, id_)
+
+    def heartbeat(self, worker, ttl):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.sadd(f'{self.queue_key}_workers', worker)
+        pipe.set(self._alive_key(worker), 1, ex=ttl)
+        pipe.execute()
+    def leave(self, worker):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.srem(f'{self.queue_key}_workers', worker)
+        pipe.delete(self._alive_key(worker))
+        pipe.execute()
+
+    def recover(self):
+        """
+        Puts jobs which were taken by workers that have since died back in the queue, failing them instead once
+        they've been attempted `max_attempts` times (e.g. if they're what keeps killing workers)
+        """
+        # Only one worker recovers at a time, so the job which is checked is also the one that gets moved
+        if not self.redis.set(f'{self.queue_key}_recovering', 1, nx=True, ex=30):
+            return 0
+
+        recovered = 0
+        try:
+            for worker in self.redis.smembers(f'{self.queue_key}_workers'):
+                worker = worker.decode('utf-8')
+                if self.redis.exists(self._alive_key(worker)):
+                    continue
+
+                processing = self._processing_key(worker)
+                while True:
+                    id_ = self.redis.lindex(processing, -1)
+                    if id_ is None:
+                        break
+                    id_ = id_.decode('utf-8')
+
+                    attempts = self.redis.hget(self._job_key(id_), 'attempts')
+                    if attempts is not None and int(attempts) >= self.max_attempts:
+                        self.failed(id_, JobError(f'Worker died while running the job ({int(attempts)} attempts)'))
+                        self.redis.rpop(processing)
+                    else:
+                        # Skipped if it's expired, rather than bringing back a job with nothing but a status
+                        if self.redis.exists(self._job_key(id_)):
+                            self._update(id_, status='queued')
+                        self.redis.rpoplpush(processing, self.queue_key)
+                        recovered += 1
+                self.redis.srem(f'{self.queue_key}_workers', worker)
+        finally:
+            self.redis.delete(f'{self.queue_key}_recovering')
+        return recovered
+
+    def started(self, id_):
+        self.redis.hincrby(self._job_key(id_), 'attempts', 1)
+        self._update(id_, status='running')
+    def done(self, id_, result):
+        self._update(id_, status='done', result=json.dumps(result))
+    def failed(self, id_, ex):
+        self._update(id_, status='failed', error=str(ex), error_type=type(ex).__name__)
+
+class WorkerException(DaemonError):
+    pass
+class Worker(Daemon):
+    error = WorkerException
+
+    def __init__(self, queue, handlers, concurrency=4, heartbeat_interval=5, recover_interval=30):
+        super().__init__('worker')
+
+        self.queue = queue
+        self.handlers = handlers
+        self.pool = gevent.pool.Pool(concurrency)
+        self.heartbeat_interval = heartbeat_interval
+        self.recover_interval = recover_interval
+
+    def _process(self, id_):
+        try:
+            job = self.queue.get(id_)
+        except JobNotFoundError:
+            self.logger.warning('job %s expired before it could run', id_)
+            self.queue.finish(self.id, id_)
+            return
+
+        self.logger.debug('running %s job %s', job['type'], id_)
+        self.queue.started(id_)
+        try:
+            result = self.handlers[job['type']](**job['args'])
+        except Exception as ex: # pylint: disable=broad-except
+            self.logger.info('%s job %s failed: %s', job['type'], id_, ex)
+            self.queue.failed(id_, ex)
+        else:
+            self.queue.done(id_, result)
+        finally:
+            self.queue.finish(self.id, id_)
+
+    def loop(self):
+        self.logger.info('starting up as %s with %d workers', self.id, self.pool.size)
+        last_recover = 0
+        while not self.exit.is_set():
+            # Heartbeats keep other workers from recovering the jobs this one is running
+            self.queue.heartbeat(self.id, 3 * self.heartbeat_interval)
+            if time.monotonic() - last_recover >= self.recover_interval:
+                recovered = self.queue.recover()
+                if recovered:
+                    self.logger.warning('requeued %d jobs from dead workers', recovered)
+                last_recover = time.monotonic()
+
+            # Only take a job off the queue once there's a free worker, so the rest stay queued in Redis
+            self.pool.wait_available(timeout=self.heartbeat_interval)
+            if self.pool.full():
+                continue
+            id_ = self.queue.next(self.id)
+            if id_ is not None:
+                self.pool.spawn(self._process, id_)
+
+        self.logger.info('shutting down')
+        while not self.pool.join(timeout=self.heartbeat_interval):
+            self.queue.heartbeat(self.id, 3 * self.heartbeat_interval)
+        self.queue.leave(self.id)
@@ -3,6 +3,32 @@ import os
 from os import path
 import subprocess
 import ipaddress
+import threading
+import fcntl
+import datetime
+import hashlib
+import zlib
+from contextlib import contextmanager
+
+import gevent
+
+from .util import Daemon, DaemonError
+
+from cryptography import x509
+from cryptography.x509.oid import NameOID, ExtendedKeyUsageOID
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa as rsa_keys, dh
+
+DN_SHORT_NAMES = {
+    NameOID.COUNTRY_NAME: 'C',
+    NameOID.STATE_OR_PROVINCE_NAME: 'ST',
+    NameOID.LOCALITY_NAME: 'L',
+    NameOID.ORGANIZATION_NAME: 'O',
+    NameOID.ORGANIZATIONAL_UNIT_NAME: 'OU',
+    NameOID.COMMON_NAME: 'CN',
+    NameOID.EMAIL_ADDRESS: 'emailAddress'
+}
 
 class EasyRSAError(Exception):
     pass
@@ -114,14 +140,297 @@ class EasyRSA:
     def build_client(self, name='client'):
         return self.build_full('client', name)
 
+def generate_key(key_size=2048):
+    return rsa_keys.generate_private_key(public_exponent=65537, key_size=key_size, backend=default_backend())
+
+class KeyPoolException(DaemonError):
+    pass
+class KeyPool(Daemon):
+    "A stock of pregenerated private keys in Redis, so that issuing certificates only needs signing"
+    error = KeyPoolException
+
+    def __init__(self, redis, size=64, refill_rate=2.0, key_size=2048, key='chad_pki_keys'):
+        super().__init__('keypool')
+        if refill_rate < 0:
+            raise KeyPoolException(f'Invalid key pool refill rate {refill_rate}')
+
+        self.redis = redis
+        self.size = size
+        self.refill_rate = refill_rate
+        self.key_size = key_size
+        self.key = key
+
+    def take(self):
+        pem = self.redis.rpop(self.key)
+        if pem is None:
+            self.redis.incr(f'{self.key}_misses')
+            return generate_key(self.key_size)
+
+        self.redis.incr(f'{self.key}_hits')
+        return serialization.load_pem_private_key(pem, None, default_backend())
+
+    def stats(self):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.llen(self.key)
+        for counter in ('hits', 'misses', 'generated'):
+            pipe.get(f'{self.key}_{counter}')
+        available, hits, misses, generated = pipe.execute()
+        return {
+            'available': available,
+            'target': self.size,
+            'key_size': self.key_size,
+            'refill_rate': self.refill_rate,
+            'hits': int(hits or 0),
+            'misses': int(misses or 0),
+            'generated': int(generated or 0)
+        }
+
+    def refill(self):
+        generated = 0
+        while not self.exit.is_set() and self.redis.llen(self.key) < self.size:
+            pem = generate_key(self.key_size).private_bytes(serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.lpush(self.key, pem)
+            pipe.incr(f'{self.key}_generated')
+            pipe.execute()
+
+            generated += 1
+            # A refill rate of 0 means as fast as keys can be generated
+            if self.refill_rate:
+                self.exit.wait(1 / self.refill_rate)
+        return generated
+
+    def loop(self):
+        self.logger.info('starting up, keeping %d %d bit keys in stock', self.size, self.key_size)
+        while not self.exit.is_set():
+            generated = self.refill()
+            if generated:
+                self.logger.info('generated %d keys', generated)
+            self.exit.wait(1)
+
+        self.logger.info('shutting down')
+
+class CryptoCA:
+    "In-process drop-in for EasyRSA, using the same PKI directory layout"
+    def __init__(self, id_, name, directory, easyrsa='/usr/share/easy-rsa', days=3650, dn=None, existing_dh=None,
+        key_size=2048, key_source=None):
+        self.id = id_
+        self.name = name
+        self.dir = path.abspath(directory)
+        self.easyrsa = easyrsa
+        self.days = days
+        self.key_size = key_size
+        self.key_source = key_source
+        self.dn = {
+            'country': 'IE',
+            'state': 'Dublin',
+            'city': 'Dublin',
+            'org': 'Netsoc',
+            'ou': 'HackTrinity',
+            'email': 'admin@hacktrinity.org'
+        }
+        if dn:
+            self.dn.update(dn)
+
+        if not path.exists(self.dir):
+            self.init_pki()
+
+        dh_path = path.join(self.dir, 'dh.pem')
+        if not path.exists(dh_path):
+            if existing_dh:
+                os.symlink(existing_dh, dh_path)
+            else:
+                self.gen_dh()
+
+    def _write(self, p, data, mode=0o644):
+        # Files are created atomically since their existence is what marks a step as done
+        p = path.join(self.dir, p)
+        tmp = f'{p}.tmp'
+        with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode), 'wb') as f:
+            f.write(data)
+        os.replace(tmp, p)
+
+    def _subject(self, cn, dn_org=False):
+        attributes = []
+        if dn_org:
+            attributes += [
+                x509.NameAttribute(NameOID.COUNTRY_NAME, self.dn['country']),
+                x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, self.dn['state']),
+                x509.NameAttribute(NameOID.LOCALITY_NAME, self.dn['city']),
+                x509.NameAttribute(NameOID.ORGANIZATION_NAME, self.dn['org']),
+                x509.NameAttribute(NameOID.ORGANIZATIONAL_UNIT_NAME, self.dn['ou'])
+            ]
+        attributes.append(x509.NameAttribute(NameOID.COMMON_NAME, cn))
+        if dn_org:
+            attributes.append(x509.NameAttribute(NameOID.EMAIL_ADDRESS, self.dn['email']))
+        return x509.Name(attributes)
+
+    def _gen_key(self, name):
+        key = self.key_source() if self.key_source else generate_key(self.key_size)
+        self._write(path.join('private', f'{name}.key'), key.private_bytes(serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8, serialization.NoEncryption()), mode=0o600)
+        return key
+
+    def _ca(self):
+        with open(path.join(self.dir, 'private', 'ca.key'), 'rb') as key_file:
+            key = serialization.load_pem_private_key(key_file.read(), None, default_backend())
+        with open(path.join(self.dir, 'ca.crt'), 'rb') as cert_file:
+            cert = x509.load_pem_x509_certificate(cert_file.read(), default_backend())
+        return key, cert
+
+    def _sign(self, subject, public_key, type_, issuer_key=None, issuer_cert=None):
+        now = datetime.datetime.utcnow()
+        serial = x509.random_serial_number()
+        builder = x509.CertificateBuilder() \
+            .subject_name(subject) \
+            .issuer_name(issuer_cert.subject if issuer_cert else subject) \
+            .public_key(public_key) \
+            .serial_number(serial) \
+            .not_valid_before(now) \
+            .not_valid_after(now + datetime.timedelta(days=self.days)) \
+            .add_extension(x509.SubjectKeyIdentifier.from_public_key(public_key), critical=False) \
+            .add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(
+                issuer_cert.public_key() if issuer_cert else public_key), critical=False)
+
+        # Extensions from easyrsa's x509-types
+        if type_ == 'ca':
+            builder = builder \
+                .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=False) \
+                .add_extension(x509.KeyUsage(digital_signature=False, content_commitment=False,
+                    key_encipherment=False, data_encipherment=False, key_agreement=False, key_cert_sign=True,
+                    crl_sign=True, encipher_only=False, decipher_only=False), critical=False)
+        else:
+            builder = builder \
+                .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=False) \
+                .add_extension(x509.KeyUsage(digital_signature=True, content_commitment=False,
+                    key_encipherment=type_ == 'server', data_encipherment=False, key_agreement=False,
+                    key_cert_sign=False, crl_sign=False, encipher_only=False, decipher_only=False), critical=False) \
+                .add_extension(x509.ExtendedKeyUsage([
+                    ExtendedKeyUsageOID.SERVER_AUTH if type_ == 'server' else ExtendedKeyUsageOID.CLIENT_AUTH
+                ]), critical=False)
+            if type_ == 'server':
+                cn = subject.get_attributes_for_oid(NameOID.COMMON_NAME)[0].value
+                builder = builder.add_extension(x509.SubjectAlternativeName([x509.DNSName(cn)]), critical=False)
+
+        cert = builder.sign(issuer_key, hashes.SHA256(), default_backend())
+        pem = cert.public_bytes(serialization.Encoding.PEM)
+
+        if issuer_cert:
+            # Keep easyrsa's (OpenSSL CA) database up to date, so `easyrsa revoke` etc. still work
+            serial_hex = f'{serial:X}'
+            serial_hex = serial_hex.rjust(len(serial_hex) + len(serial_hex) % 2, '0')
+            dn = ''.join(map(lambda a: f'/{DN_SHORT_NAMES[a.oid]}={a.value}', subject))
+            with open(path.join(self.dir, 'index.txt'), 'a') as index:
+                index.write(f'V\t{cert.not_valid_after:%y%m%d%H%M%S}Z\t\t{serial_hex}\tunknown\t{dn}\n')
+            self._write(path.join('certs_by_serial', f'{serial_hex}.pem'), pem)
+        return pem
+
+    def init_pki(self):
+        for d in ('private', 'reqs', 'issued', 'certs_by_serial', 'revoked'):
+            os.makedirs(path.join(self.dir, d), exist_ok=True)
+        self._write('index.txt', b'')
+        self._write('index.txt.attr', b'unique_subject = no\n')
+        self._write('serial', b'01\n')
+
+    def gen_ovpn_key(self):
+        ta_path = path.join(self.dir, 'ta.key')
+        if path.exists(ta_path):
+            return ta_path
+
+        # Same format as `openvpn --genkey --secret`
+        key = os.urandom(256).hex()
+        lines = [key[i:i + 32] for i in range(0, len(key), 32)]
+        self._write('ta.key', '\n'.join([
+            '#',
+            '# 2048 bit OpenVPN static key',
+            '#',
+            '-----BEGIN OpenVPN Static key V1-----',
+            *lines,
+            '-----END OpenVPN Static key V1-----',
+            ''
+        ]).encode('ascii'), mode=0o600)
+        return ta_path
+
+    def gen_dh(self):
+        params = dh.generate_parameters(generator=2, key_size=self.key_size, backend=default_backend())
+        self._write('dh.pem', params.parameter_bytes(serialization.Encoding.PEM, serialization.ParameterFormat.PKCS3))
+
+    def build_ca(self):
+        if path.exists(path.join(self.dir, 'ca.crt')):
+            return
+
+        key = self._gen_key('ca')
+        self._write('ca.crt', self._sign(self._subject(self.name, dn_org=True), key.public_key(), 'ca', key))
+
+    def req_sub_ca(self):
+        key = self._gen_key('ca')
+        req = x509.CertificateSigningRequestBuilder() \
+            .subject_name(self._subject(self.name, dn_org=True)) \
+            .sign(key, hashes.SHA256(), default_backend())
+        self._write(path.join('reqs', 'ca.req'), req.public_bytes(serialization.Encoding.PEM))
+        return path.join(self.dir, 'reqs/ca.req')
+
+    def build_child_ca(self, child):
+        child_ca_path = path.join(child.dir, 'ca.crt')
+        if path.exists(child_ca_path):
+            return False
+
+        req_name = f'{child.id}_ca'
+        with open(child.req_sub_ca(), 'rb') as req_file:
+            req = x509.load_pem_x509_csr(req_file.read(), default_backend())
+        self._write(path.join('reqs', f'{req_name}.req'), req.public_bytes(serialization.Encoding.PEM))
+
+        ca_key, ca_cert = self._ca()
+        self._write(path.join('issued', f'{req_name}.crt'),
+            self._sign(req.subject, req.public_key(), 'ca', ca_key, ca_cert))
+        os.symlink(path.join(self.dir, 'issued', f'{req_name}.crt'), child_ca_path)
+        return True
+
+    def build_full(self, type_, name, dn_org=False):
+        cert_path = path.join(self.dir, 'issued', f'{name}.crt')
+        key_path = path.join(self.dir, 'private', f'{name}.key')
+        if path.exists(cert_path):
+            return cert_path, key_path
+
+        key = self._gen_key(name)
+        subject = self._subject(name, dn_org=dn_org)
+        req = x509.CertificateSigningRequestBuilder().subject_name(subject).sign(key, hashes.SHA256(), default_backend())
+        self._write(path.join('reqs', f'{name}.req'), req.public_bytes(serialization.Encoding.PEM))
+
+        ca_key, ca_cert = self._ca()
+        self._write(path.join('issued', f'{name}.crt'), self._sign(subject, key.public_key(), type_, ca_key, ca_cert))
+        return cert_path, key_path
+    def build_server(self, name='server'):
+        return self.build_full('server', name, dn_org=True)
+    def build_client(self, name='client'):
+        return self.build_full('client', name)
+
 class PKI:
     def __init__(self, directory='/etc/chad_pki', easyrsa='/usr/share/easy-rsa', domain='chad-gw.sys.hacktrinity.org',
-        dn=None):
+        dn=None, redis=None, cache_prefix='chad_pki_', cache_ttl=86400, backend='easyrsa', key_pool=None, locks=64):
         self.dir = directory
         self.domain = domain
-        self.root = EasyRSA('chad_root', 'HackTrinity CHAD Root CA', path.join(self.dir, 'root'),
-            easyrsa=easyrsa, dn=dn)
-        self.root.build_ca()
+        self.redis = redis
+        self.cache_prefix = cache_prefix
+        self.cache_ttl = cache_ttl
+        # A fixed set of locks which names are hashed onto, rather than one per user forever
+        self._locks = [threading.Lock() for _ in range(locks)]
+        if backend == 'cryptography':
+            self.ca_class = CryptoCA
+            self.ca_args = {'key_source': key_pool.take, 'key_size': key_pool.key_size} if key_pool else {}
+        else:
+            self.ca_class = EasyRSA
+            self.ca_args = {}
+
+        os.makedirs(self.dir, exist_ok=True)
+        with self._locked('root'):
+            self.root = self.ca_class('chad_root', 'HackTrinity CHAD Root CA', path.join(self.dir, 'root'),
+                easyrsa=easyrsa, dn=dn, **self.ca_args)
+            self.root.build_ca()
+        # Cached profiles are keyed by the root CA, so regenerating the PKI doesn't leave stale ones behind
+        with open(path.join(self.root.dir, 'ca.crt'), 'rb') as ca_file:
+            self.fingerprint = hashlib.sha256(ca_file.read()).hexdigest()[:16]
 
         with open('CHAD/ovpn_server.conf.tpl') as tpl_file:
             self.server_template = string.Template(tpl_file.read())
@@ -129,18 +438,53 @@ class PKI:
             self.client_template = string.Template(tpl_file.read())
         self.users = {}
 
+    @contextmanager
+    def _locked(self, name):
+        # The in-process lock stops greenlets from blocking each other's process on the file lock, which in turn
+        # keeps gunicorn workers, the cleanup process and other replicas out of the same easyrsa directory
+        with self._locks[zlib.crc32(name.encode('utf-8')) % len(self._locks)]:
+            with open(path.join(self.dir, f'{name}.lock'), 'w') as lock_file:
+                # Waiting on the file lock would otherwise block every greenlet in the process
+                gevent.get_hub().threadpool.apply(fcntl.flock, (lock_file, fcntl.LOCK_EX))
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
     def _get_user(self, user_id):
         id_ = f'user_{user_id}'
         if user_id not in self.users:
-            rsa = EasyRSA(id_, f'HackTrinity CHAD User {user_id} CA', path.join(self.dir, id_),
-                easyrsa=self.root.easyrsa, dn=self.root.dn, existing_dh=path.join(self.root.dir, 'dh.pem'))
-            rsa.build_ca()
-            rsa.gen_ovpn_key()
-            self.users[user_id] = rsa
-            self.get_server(user_id)
-            self.get_client(user_id)
+            with self._locked(id_):
+                if user_id not in self.users:
+                    rsa = self.ca_class(id_, f'HackTrinity CHAD User {user_id} CA', path.join(self.dir, id_),
+                        easyrsa=self.root.easyrsa, dn=self.root.dn, existing_dh=path.join(self.root.dir, 'dh.pem'),
+                        **self.ca_args)
+                    rsa.build_ca()
+                    rsa.gen_ovpn_key()
+                    self.users[user_id] = rsa
+                    self.get_server(user_id)
+                    self.get_client(user_id)
         return self.users[user_id]
 
+    def _cache_key(self, user_id):
+        return f'{self.cache_prefix}{self.fingerprint}_{user_id}'
+
+    def _cached(self, user_id, field, render):
+        if self.redis is None:
+            return render()
+
+        key = self._cache_key(user_id)
+        value = self.redis.hget(key, field)
+        if value is not None:
+            return value.decode('utf-8')
+
+        value = render()
+        pipe = self.redis.pipeline()
+        pipe.hset(key, field, value)
+        pipe.expire(key, self.cache_ttl)
+        pipe.execute()
+        return value
+
     def get_server(self, user_id):
         return self._get_user(user_id).build_server(f'{user_id}.{self.domain}')
     def get_client(self, user_id):
@@ -153,19 +497,40 @@ class PKI:
         rsa = self._get_user(user_id)
         with open(path.join(rsa.dir, p)) as f:
             return f.read()
+    @staticmethod
+    def _pool(pool_start, pool_end, network):
+        return f'{pool_start} {pool_end} {ipaddress.IPv4Network(network).netmask}'
+
+    def provision(self, user_id, pool_start, pool_end, network):
+        "Makes sure a user's PKI and rendered profiles exist, returning False if there was nothing to do"
+        pool = self._pool(pool_start, pool_end, network)
+        if self.redis is not None:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.hexists(self._cache_key(user_id), f'server:{self.domain}:{pool}')
+            pipe.hexists(self._cache_key(user_id), f'client:{self.domain}')
+            if all(pipe.execute()):
+                return False
+        elif path.exists(path.join(self.dir, f'user_{user_id}', 'issued', 'client.crt')):
+            return False
+
+        self.generate_server_ovpn(user_id, pool_start, pool_end, network)
+        self.generate_client_ovpn(user_id)
+        return True
+
     def generate_server_ovpn(self, user_id, pool_start, pool_end, network):
-        return self.server_template.substitute(
-            pool=f'{pool_start} {pool_end} {ipaddress.IPv4Network(network).netmask}',
+        pool = self._pool(pool_start, pool_end, network)
+        return self._cached(user_id, f'server:{self.domain}:{pool}', lambda: self.server_template.substitute(
+            pool=pool,
             ca=self._read_user_file(user_id, 'ca.crt'),
             cert=self._read_user_file(user_id, f'issued/{user_id}.{self.domain}.crt'),
             key=self._read_user_file(user_id, f'private/{user_id}.{self.domain}.key'),
             dh=self._read_user_file(user_id, f'dh.pem'),
-            ta_key=self._read_user_file(user_id, f'ta.key'))
+            ta_key=self._read_user_file(user_id, f'ta.key')))
     def generate_client_ovpn(self, user_id):
-        return self.client_template.substitute(
+        return self._cached(user_id, f'client:{self.domain}', lambda: self.client_template.substitute(
             ca=self._read_user_file(user_id, 'ca.crt'),
             cert=self._read_user_file(user_id, f'issued/client.crt'),
             key=self._read_user_file(user_id, f'private/client.key'),
             ta_key=self._read_user_file(user_id, f'ta.key'),
             server=f'{user_id}.{self.domain}',
-            proxy=self.domain)
+            proxy=self.domain))
@@ -1,11 +1,211 @@
+from string import Template
+from abc import ABC, abstractmethod
+import copy
 import subprocess
+import shlex
 import json
+import re
+import logging
+import threading
+import time
+import calendar
+
+import docker
+
+NAMESPACE_LABEL = 'com.docker.stack.namespace'
+
+DURATION_REGEX = re.compile('([\\d.]+)(ns|us|ms|s|m|h)')
+DURATION_UNITS = {'ns': 1, 'us': 1e3, 'ms': 1e6, 's': 1e9, 'm': 60e9, 'h': 3600e9}
+SUPPORTED_SERVICE_KEYS = {
+    'image', 'command', 'entrypoint', 'environment', 'labels', 'hostname', 'user', 'working_dir', 'tty',
+    'stdin_open', 'read_only', 'stop_signal', 'stop_grace_period', 'init', 'group_add', 'networks', 'secrets',
+    'volumes', 'ports', 'extra_hosts', 'dns', 'dns_search', 'healthcheck', 'deploy'
+}
 
 class StackError(Exception):
     pass
 
-class StackManager:
-    def __init__(self, sock='unix:///run/docker.sock'):
+class StackInventory:
+    def __init__(self, docker_, interval=30, converge_interval=2, converge_window=60):
+        self.running = False
+        self.logger = logging.getLogger('inventory')
+
+        self.docker = docker_
+        self.interval = interval
+        self.converge_interval = converge_interval
+        self.converge_window = converge_window
+
+        self._stacks = frozenset()
+        self._services = {}
+        self._converging = False
+        self._changes = []
+        self._lock = threading.Lock()
+        self._stale = threading.Event()
+
+    def __contains__(self, name):
+        return name in self._stacks
+    def __iter__(self):
+        return iter(self._stacks)
+    def __len__(self):
+        return len(self._stacks)
+
+    def snapshot(self):
+        return self._stacks
+    def services(self, name):
+        "Replica status of a stack's services as of the last refresh"
+        return self._services.get(name, [])
+
+    def _apply(self, name, present):
+        with self._lock:
+            # Recorded so that a refresh racing with this change doesn't clobber it with a stale listing
+            self._changes.append((name, present))
+            if present:
+                self._stacks = self._stacks | {name}
+            else:
+                self._stacks = self._stacks - {name}
+    def add(self, name):
+        self._apply(name, True)
+    def discard(self, name):
+        self._apply(name, False)
+
+    def refresh(self):
+        with self._lock:
+            self._changes = []
+
+        # `docker stack ls` is derived from service labels, so this is the same listing without forking the CLI
+        services = self.docker.api.services(filters={'label': NAMESPACE_LABEL})
+        stacks = set(map(lambda s: s['Spec']['Labels'][NAMESPACE_LABEL], services))
+
+        desired, running = {}, {}
+        for task in self.docker.api.tasks(filters={'desired-state': 'running'}):
+            desired[task['ServiceID']] = desired.get(task['ServiceID'], 0) + 1
+            if task['Status']['State'] == 'running':
+                running[task['ServiceID']] = running.get(task['ServiceID'], 0) + 1
+        stack_services = {}
+        converging = False
+        for service in services:
+            mode = service['Spec']['Mode']
+            status = {
+                'name': service['Spec']['Name'],
+                'mode': 'global' if 'Global' in mode else 'replicated',
+                'running': running.get(service['ID'], 0),
+                'replicas': desired.get(service['ID'], 0) if 'Global' in mode else
+                    mode['Replicated'].get('Replicas', 1)
+            }
+            stack_services.setdefault(service['Spec']['Labels'][NAMESPACE_LABEL], []).append(status)
+
+            # Tasks starting or stopping don't produce service events (and container events are only for the local
+            # node), so refresh quickly while recently created or updated services converge. Ones which never do (e.g.
+            # crash looping challenges) stop counting after `converge_window`.
+            if status['running'] != status['replicas'] and \
+                time.time() - parse_timestamp(service['UpdatedAt']) < self.converge_window:
+                converging = True
+
+        with self._lock:
+            for name, present in self._changes:
+                if present:
+                    stacks.add(name)
+                else:
+                    stacks.discard(name)
+            self._changes = []
+            self._stacks = frozenset(stacks)
+            self._services = stack_services
+            self._converging = converging
+
+    def start(self):
+        if self.running:
+            raise StackError('Inventory already running')
+
+        self.running = True
+        self.refresh()
+        threading.Thread(target=self._watch_events, name='inventory-events', daemon=True).start()
+        threading.Thread(target=self._refresh_loop, name='inventory-refresh', daemon=True).start()
+
+    def _watch_events(self):
+        while True:
+            try:
+                for _event in self.docker.events(filters={'type': 'service'}, decode=True):
+                    self._stale.set()
+            except Exception: # pylint: disable=broad-except
+                self.logger.exception('docker event stream failed, reconnecting')
+            time.sleep(1)
+
+    def _refresh_loop(self):
+        while True:
+            # Event bursts (e.g. a stack deploy creating several services) coalesce into a single refresh
+            self._stale.wait(self.converge_interval if self._converging else self.interval)
+            self._stale.clear()
+            try:
+                self.refresh()
+            except Exception: # pylint: disable=broad-except
+                self.logger.exception('failed to refresh stack inventory')
+
+class BaseStackManager(ABC):
+    def __init__(self, inventory=None):
+        self.inventory = inventory
+
+    @property
+    def _inventory(self):
+        # Only a process which has started the inventory (i.e. the API server) has it kept up to date
+        if self.inventory is not None and self.inventory.running:
+            return self.inventory
+        return None
+
+    @abstractmethod
+    def _ls(self):
+        pass
+    @abstractmethod
+    def deploy(self, name, spec, prune=False, registry_auth=False):
+        pass
+    @abstractmethod
+    def rm(self, name):
+        pass
+
+    def ls(self):
+        if self._inventory is not None:
+            return self._inventory.snapshot()
+        return self._ls()
+
+    def exists(self, name):
+        if self._inventory is not None:
+            return name in self._inventory
+        return name in self._ls()
+
+    @abstractmethod
+    def services(self, id_):
+        pass
+
+    def status(self, name):
+        "Replica status of a stack's services, from the inventory if there is one"
+        if self._inventory is not None:
+            return self._inventory.services(name)
+
+        result = []
+        for service in self.services(name):
+            running, _, replicas = service['Replicas'].split(' ')[0].partition('/')
+            result.append({
+                'name': service['Name'],
+                'mode': service['Mode'],
+                'running': int(running),
+                'replicas': int(replicas)
+            })
+        return result
+
+    def renamed(self, old, new):
+        "Records that a stack's services have been moved into another namespace (by relabelling them)"
+        self._removed(old)
+        self._deployed(new)
+
+    def _deployed(self, name):
+        if self.inventory is not None:
+            self.inventory.add(name)
+    def _removed(self, name):
+        if self.inventory is not None:
+            self.inventory.discard(name)
+
+class StackManager(BaseStackManager):
+    def __init__(self, sock='unix:///run/docker.sock', inventory=None):
+        super().__init__(inventory=inventory)
         self.sock = sock
 
     def _docker_cmd(self, args, *e_args, parse=True, **kwargs):
@@ -21,7 +221,7 @@ class StackManager:
             return map(json.loads, lines)
         return lines
 
-    def ls(self):
+    def _ls(self):
         return list(map(lambda s: s['Name'], self._docker_cmd(['stack', 'ls', '--format', '{{json .}}'])))
 
     def services(self, id_):
@@ -36,6 +236,475 @@ class StackManager:
         args.append(name)
 
         self._docker_cmd(args, input=json.dumps(spec), parse=False)
+        self._deployed(name)
 
     def rm(self, name):
         self._docker_cmd(['stack', 'rm', name], parse=False)
+        self._removed(name)
+
+def parse_duration(d):
+    "Parses a compose file duration (e.g. `1m30s`) into nanoseconds"
+    if d is None:
+        return None
+    if isinstance(d, (int, float)):
+        return int(d * 1e9)
+
+    total = 0
+    for value, unit in DURATION_REGEX.findall(d):
+        total += float(value) * DURATION_UNITS[unit]
+    return int(total)
+
+def parse_timestamp(t):
+    # Docker's timestamps are always UTC, with nanoseconds (which aren't needed here)
+    return calendar.timegm(time.strptime(t[:19], '%Y-%m-%dT%H:%M:%S'))
+
+def parse_labels(labels):
+    if not labels:
+        return {}
+    if isinstance(labels, dict):
+        return {k: '' if v is None else str(v) for k, v in labels.items()}
+    return dict(map(lambda l: (l.split('=', 1) + [''])[:2], labels))
+
+def parse_env(env):
+    if not env:
+        return []
+    if isinstance(env, dict):
+        return [k if v is None else f'{k}={v}' for k, v in env.items()]
+    return list(env)
+
+def parse_port(port):
+    if isinstance(port, dict):
+        result = {
+            'TargetPort': int(port['target']),
+            'Protocol': port.get('protocol', 'tcp'),
+            'PublishMode': port.get('mode', 'ingress')
+        }
+        if 'published' in port:
+            result['PublishedPort'] = int(port['published'])
+        return result
+
+    port, _, protocol = str(port).partition('/')
+    published, _, target = port.rpartition(':')
+    result = {
+        'TargetPort': int(target),
+        'Protocol': protocol or 'tcp',
+        'PublishMode': 'ingress'
+    }
+    if published:
+        result['PublishedPort'] = int(published)
+    return result
+
+class StackTemplate:
+    """
+    A compose spec with `$placeholders` (see `string.Template`) compiled ahead of time, so that only the strings which
+    contain a `$` are substituted when rendering. Rendered specs are full copies, which can be modified freely.
+    """
+    def __init__(self, spec):
+        self.spec = copy.deepcopy(spec)
+        self.slots = self._compile(spec)
+        self.placeholders = frozenset(self._placeholders(self.slots))
+
+    @classmethod
+    def _placeholders(cls, slots):
+        if slots is None:
+            return
+        if isinstance(slots, Template):
+            for match in slots.pattern.finditer(slots.template):
+                if match.group('named') or match.group('braced'):
+                    yield match.group('named') or match.group('braced')
+            return
+
+        for key, value in slots.values():
+            yield from cls._placeholders(key)
+            yield from cls._placeholders(value)
+
+    @classmethod
+    def _compile(cls, node):
+        if isinstance(node, str):
+            return Template(node) if '$' in node else None
+
+        if isinstance(node, dict):
+            items = node.items()
+        elif isinstance(node, list):
+            items = enumerate(node)
+        else:
+            return None
+
+        # Maps each key to a template for the key itself (only for dicts) and the slots within its value
+        slots = {}
+        for k, v in items:
+            key = Template(k) if isinstance(k, str) and '$' in k else None
+            value = cls._compile(v)
+            if key is not None or value is not None:
+                slots[k] = (key, value)
+        return slots or None
+
+    @classmethod
+    def _render(cls, node, slots, context):
+        if isinstance(slots, Template):
+            return slots.safe_substitute(context)
+
+        # Everything without placeholders is copied too, so that changes to a rendered spec can't make their way into
+        # the template (and every spec rendered from it after that)
+        if isinstance(node, list):
+            return [cls._render(v, slots[i][1], context) if i in slots else copy.deepcopy(v)
+                for i, v in enumerate(node)]
+
+        result = {}
+        for k, v in node.items():
+            if k not in slots:
+                result[k] = copy.deepcopy(v)
+                continue
+
+            key, value = slots[k]
+            result[k if key is None else key.safe_substitute(context)] = \
+                copy.deepcopy(v) if value is None else cls._render(v, value, context)
+        return result
+
+    def render(self, context):
+        "Produces a copy of the spec with placeholders substituted"
+        if self.slots is None:
+            return copy.deepcopy(self.spec)
+        return self._render(self.spec, self.slots, context)
+
+class APIStackManager(BaseStackManager):
+    def __init__(self, docker_, inventory=None):
+        super().__init__(inventory=inventory)
+        self.docker = docker_
+
+    def _namespaced(self, name):
+        return self.docker.api.services(filters={'label': f'{NAMESPACE_LABEL}={name}'})
+
+    def _ls(self):
+        services = self.docker.api.services(filters={'label': NAMESPACE_LABEL})
+        return sorted(set(map(lambda s: s['Spec']['Labels'][NAMESPACE_LABEL], services)))
+
+    def services(self, id_):
+        services = self._namespaced(id_)
+        running = {}
+        if services:
+            tasks = self.docker.api.tasks(filters={
+                'service': list(map(lambda s: s['ID'], services)),
+                'desired-state': 'running'
+            })
+            for task in filter(lambda t: t['Status']['State'] == 'running', tasks):
+                running[task['ServiceID']] = running.get(task['ServiceID'], 0) + 1
+
+        # Same fields as `docker stack services --format '{{json .}}'`
+        result = []
+        for service in services:
+            mode = service['Spec']['Mode']
+            if 'Global' in mode:
+                mode_name, replicas = 'global', str(len(running))
+            else:
+                mode_name, replicas = 'replicated', str(mode['Replicated'].get('Replicas', 1))
+            ports = service.get('Endpoint', {}).get('Ports', [])
+            result.append({
+                'ID': service['ID'],
+                'Name': service['Spec']['Name'],
+                'Mode': mode_name,
+                'Replicas': f'{running.get(service["ID"], 0)}/{replicas}',
+                'Image': service['Spec']['TaskTemplate']['ContainerSpec']['Image'].split('@')[0],
+                'Ports': ', '.join(map(
+                    lambda p: f'*:{p.get("PublishedPort")}->{p["TargetPort"]}/{p["Protocol"]}', ports))
+            })
+        return result
+
+    def _validate(self, spec):
+        "Rejects a stack which can't be deployed as described, before anything is created for it"
+        networks, secrets = spec.get('networks', {}), spec.get('secrets', {})
+        for service_name, conf in spec.get('services', {}).items():
+            unsupported = set(conf.keys()) - SUPPORTED_SERVICE_KEYS
+            if unsupported:
+                # Deploying without them would leave the service silently different to what the stack describes
+                raise StackError(
+                    f'Service "{service_name}" uses unsupported options: {", ".join(sorted(unsupported))}')
+            if 'image' not in conf:
+                raise StackError(f'Service "{service_name}" has no image')
+
+            for key in conf.get('networks', ['default']):
+                if key not in networks:
+                    raise StackError(f'Service "{service_name}" references undefined network "{key}"')
+            for ref in conf.get('secrets', []):
+                source = ref if isinstance(ref, str) else ref['source']
+                if source not in secrets:
+                    raise StackError(f'Service "{service_name}" references undefined secret "{source}"')
+
+        for key, conf in secrets.items():
+            if not conf.get('external') and 'file' not in conf:
+                raise StackError(f'Secret "{key}" has neither a file nor is external')
+
+    def _deploy_networks(self, name, spec, labels, created):
+        networks = {}
+        for key, conf in spec.get('networks', {}).items():
+            conf = conf or {}
+            external = conf.get('external', False)
+            if external:
+                real_name = external['name'] if isinstance(external, dict) else conf.get('name', key)
+                try:
+                    networks[key] = self.docker.networks.get(real_name).id
+                except docker.errors.NotFound:
+                    raise StackError(f'External network "{real_name}" not found')
+                continue
+
+            real_name = conf.get('name', f'{name}_{key}')
+            existing = list(filter(lambda n, r=real_name: n['Name'] == r,
+                self.docker.api.networks(names=[real_name])))
+            if existing:
+                networks[key] = existing[0]['Id']
+                continue
+
+            ipam = None
+            if 'ipam' in conf:
+                ipam = docker.types.IPAMConfig(
+                    driver=conf['ipam'].get('driver', 'default'),
+                    pool_configs=list(map(lambda c: docker.types.IPAMPool(**c), conf['ipam'].get('config', []))))
+            networks[key] = self.docker.networks.create(
+                real_name,
+                driver=conf.get('driver', 'overlay'),
+                options=conf.get('driver_opts'),
+                ipam=ipam,
+                internal=conf.get('internal', False),
+                attachable=conf.get('attachable', False),
+                labels={**parse_labels(conf.get('labels')), **labels}
+            ).id
+            created.append(('network', networks[key]))
+        return networks
+
+    def _deploy_secrets(self, name, spec, labels, created):
+        secrets = {}
+        for key, conf in spec.get('secrets', {}).items():
+            external = conf.get('external', False)
+            if external:
+                real_name = external['name'] if isinstance(external, dict) else conf.get('name', key)
+            else:
+                real_name = conf.get('name', f'{name}_{key}')
+
+            try:
+                secret = self.docker.secrets.get(real_name)
+            except docker.errors.NotFound:
+                if external:
+                    raise StackError(f'External secret "{real_name}" not found')
+
+                # Secrets are immutable, so (like the CLI) an existing one with the same name is reused
+                try:
+                    with open(conf['file'], 'rb') as secret_file:
+                        data = secret_file.read()
+                except OSError as ex:
+                    raise StackError(f'Failed to read secret "{key}": {ex}')
+                secret = self.docker.secrets.create(name=real_name, data=data,
+                    labels={**parse_labels(conf.get('labels')), **labels})
+                created.append(('secret', secret.id))
+            secrets[key] = (secret.id, real_name)
+        return secrets
+
+    def _service_kwargs(self, name, service_name, conf, spec, networks, secrets, labels):
+        deploy = conf.get('deploy', {})
+        kwargs = {
+            'name': f'{name}_{service_name}',
+            'labels': {**parse_labels(deploy.get('labels')), **labels, 'com.docker.stack.image': conf['image']},
+            'container_labels': {**parse_labels(conf.get('labels')), **labels},
+            'env': parse_env(conf.get('environment')),
+            'hostname': conf.get('hostname'),
+            'user': conf.get('user'),
+            'workdir': conf.get('working_dir'),
+            'tty': conf.get('tty', False),
+            'open_stdin': conf.get('stdin_open', False),
+            'read_only': conf.get('read_only', False),
+            'stop_signal': conf.get('stop_signal'),
+            'stop_grace_period': parse_duration(conf.get('stop_grace_period')),
+            'init': conf.get('init'),
+            'groups': conf.get('group_add')
+        }
+
+        for key, arg in (('command', 'args'), ('entrypoint', 'command')):
+            if key in conf:
+                kwargs[arg] = shlex.split(conf[key]) if isinstance(conf[key], str) else conf[key]
+
+        attachments = conf.get('networks', ['default'])
+        if isinstance(attachments, list):
+            attachments = dict.fromkeys(attachments)
+        kwargs['networks'] = []
+        for key, attachment in attachments.items():
+            attachment = attachment or {}
+            kwargs['networks'].append({
+                'Target': networks[key],
+                'Aliases': [service_name] + attachment.get('aliases', [])
+            })
+
+        kwargs['secrets'] = []
+        for ref in conf.get('secrets', []):
+            if isinstance(ref, str):
+                ref = {'source': ref}
+            secret_id, secret_name = secrets[ref['source']]
+            kwargs['secrets'].append(docker.types.SecretReference(secret_id, secret_name,
+                filename=ref.get('target', ref['source']), uid=str(ref.get('uid', '0')),
+                gid=str(ref.get('gid', '0')), mode=ref.get('mode', 0o444)))
+
+        kwargs['mounts'] = []
+        for volume in conf.get('volumes', []):
+            if isinstance(volume, str):
+                volume = docker.types.Mount.parse_mount_string(volume)
+                volume = {
+                    'type': volume['Type'],
+                    'source': volume['Source'],
+                    'target': volume['Target'],
+                    'read_only': volume['ReadOnly']
+                }
+            mount_args = {'read_only': volume.get('read_only', False)}
+            source = volume.get('source')
+            if volume.get('type', 'volume') == 'volume' and source:
+                volume_conf = spec.get('volumes', {}).get(source) or {}
+                if volume_conf.get('external'):
+                    source = volume_conf.get('name', source)
+                else:
+                    source = volume_conf.get('name', f'{name}_{source}')
+                    mount_args['labels'] = {**parse_labels(volume_conf.get('labels')), **labels}
+                    if 'driver' in volume_conf:
+                        mount_args['driver_config'] = docker.types.DriverConfig(volume_conf['driver'],
+                            volume_conf.get('driver_opts'))
+            kwargs['mounts'].append(docker.types.Mount(volume['target'], source,
+                type=volume.get('type', 'volume'), **mount_args))
+
+        if 'ports' in conf or 'endpoint_mode' in deploy:
+            endpoint_spec = {'Ports': list(map(parse_port, conf.get('ports', [])))}
+            if 'endpoint_mode' in deploy:
+                endpoint_spec['Mode'] = deploy['endpoint_mode']
+            kwargs['endpoint_spec'] = endpoint_spec
+
+        if 'extra_hosts' in conf:
+            hosts = conf['extra_hosts']
+            if isinstance(hosts, list):
+                hosts = dict(map(lambda h: h.split(':', 1), hosts))
+            kwargs['hosts'] = hosts
+        if 'dns' in conf or 'dns_search' in conf:
+            listify = lambda v: [v] if isinstance(v, str) else v
+            kwargs['dns_config'] = docker.types.DNSConfig(nameservers=listify(conf.get('dns')),
+                search=listify(conf.get('dns_search')))
+        if 'healthcheck' in conf:
+            healthcheck = conf['healthcheck']
+            kwargs['healthcheck'] = docker.types.Healthcheck(
+                test=['NONE'] if healthcheck.get('disable') else healthcheck.get('test'),
+                interval=parse_duration(healthcheck.get('interval')),
+                timeout=parse_duration(healthcheck.get('timeout')),
+                retries=healthcheck.get('retries'),
+                start_period=parse_duration(healthcheck.get('start_period')))
+
+        if deploy.get('mode') == 'global':
+            kwargs['mode'] = docker.types.ServiceMode('global')
+        else:
+            kwargs['mode'] = docker.types.ServiceMode('replicated', deploy.get('replicas', 1))
+
+        resources = deploy.get('resources', {})
+        limits, reservations = resources.get('limits', {}), resources.get('reservations', {})
+        if limits or reservations:
+            nano_cpus = lambda c: int(float(c) * 1e9) if c is not None else None
+            kwargs['resources'] = docker.types.Resources(
+                cpu_limit=nano_cpus(limits.get('cpus')),
+                mem_limit=docker.utils.parse_bytes(limits['memory']) if 'memory' in limits else None,
+                cpu_reservation=nano_cpus(reservations.get('cpus')),
+                mem_reservation=docker.utils.parse_bytes(reservations['memory']) if 'memory' in reservations else None)
+
+        restart = deploy.get('restart_policy')
+        if restart:
+            kwargs['restart_policy'] = docker.types.RestartPolicy(
+                condition=restart.get('condition', 'any'),
+                delay=parse_duration(restart.get('delay', 0)),
+                max_attempts=restart.get('max_attempts', 0),
+                window=parse_duration(restart.get('window', 0)))
+
+        placement = deploy.get('placement', {})
+        if 'constraints' in placement:
+            kwargs['constraints'] = placement['constraints']
+        if 'preferences' in placement:
+            kwargs['preferences'] = [(s, d) for p in placement['preferences'] for s, d in p.items()]
+
+        update = deploy.get('update_config')
+        if update:
+            kwargs['update_config'] = docker.types.UpdateConfig(
+                parallelism=update.get('parallelism', 1),
+                delay=parse_duration(update.get('delay')),
+                failure_action=update.get('failure_action', 'pause'),
+                monitor=parse_duration(update.get('monitor')),
+                max_failure_ratio=update.get('max_failure_ratio'),
+                order=update.get('order'))
+
+        return {k: v for k, v in kwargs.items() if v is not None}
+
+    def deploy(self, name, spec, prune=False, registry_auth=False):
+        # The SDK client always sends credentials for the image's registry if it has them (like the CLI's
+        # `--with-registry-auth`), so `registry_auth` is accepted only for interface compatibility
+        labels = {NAMESPACE_LABEL: name}
+        services = spec.get('services', {})
+
+        if any(map(lambda s: 'networks' not in s, services.values())):
+            spec = dict(spec, networks={'default': None, **spec.get('networks', {})})
+        self._validate(spec)
+
+        created = []
+        try:
+            networks = self._deploy_networks(name, spec, labels, created)
+            secrets = self._deploy_secrets(name, spec, labels, created)
+
+            existing = {s['Spec']['Name']: s['ID'] for s in self._namespaced(name)}
+            for service_name, conf in services.items():
+                kwargs = self._service_kwargs(name, service_name, conf, spec, networks, secrets, labels)
+                if kwargs['name'] in existing:
+                    self.docker.services.get(existing.pop(kwargs['name'])).update(image=conf['image'], **kwargs)
+                else:
+                    self.docker.services.create(conf['image'], **kwargs)
+
+            if prune:
+                for service_id in existing.values():
+                    self.docker.api.remove_service(service_id)
+        except (StackError, docker.errors.APIError) as ex:
+            # Stacks are only found (and so removed) by their services, so without any these would never go
+            if not self._namespaced(name):
+                self._rollback(created)
+            if isinstance(ex, StackError):
+                raise
+            raise StackError(f'Failed to deploy stack {name}: {ex.explanation}')
+        self._deployed(name)
+
+    def _rollback(self, created):
+        for kind, id_ in reversed(created):
+            try:
+                if kind == 'network':
+                    self._remove_network(id_)
+                else:
+                    self.docker.api.remove_secret(id_)
+            except docker.errors.APIError:
+                pass
+
+    def _remove_network(self, network_id, timeout=10):
+        # Networks can't be removed until the tasks of removed services have let go of their endpoints
+        deadline = time.time() + timeout
+        while True:
+            try:
+                self.docker.api.remove_network(network_id)
+                return
+            except docker.errors.NotFound:
+                return
+            except docker.errors.APIError:
+                if time.time() >= deadline:
+                    raise
+                time.sleep(0.5)
+
+    def rm(self, name):
+        label_filter = {'label': f'{NAMESPACE_LABEL}={name}'}
+        try:
+            for service in self._namespaced(name):
+                try:
+                    self.docker.api.remove_service(service['ID'])
+                except docker.errors.NotFound:
+                    pass
+            for secret in self.docker.api.secrets(filters=label_filter):
+                try:
+                    self.docker.api.remove_secret(secret['ID'])
+                except docker.errors.NotFound:
+                    pass
+            for network in self.docker.api.networks(filters=label_filter):
+                self._remove_network(network['Id'])
+        except docker.errors.APIError as ex:
+            raise StackError(f'Failed to remove stack {name}: {ex.explanation}')
+        self._removed(name)
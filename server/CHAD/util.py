@@ -1,7 +1,16 @@
 from functools import wraps
+from abc import ABC, abstractmethod
 import itertools
 import random
 import os
+import socket
+import logging
+import threading
+import signal
+import struct
+import hashlib
+import mmap
+import tempfile
 
 from marshmallow import Schema
 from flask import request, jsonify
@@ -26,6 +35,17 @@ def var_or_secret(var, default=None, default_file=None, binary=False):
             value = default
     return value
 
+def parse_id_list(s):
+    "Parses a list of IDs and ID ranges, e.g. `1-5,8,10-12`"
+    ids = []
+    for part in filter(lambda p: p, map(str.strip, (s or '').split(','))):
+        start, _, end = part.partition('-')
+        if end:
+            ids += range(int(start), int(end) + 1)
+        else:
+            ids.append(int(start))
+    return ids
+
 def subset_sum(numbers, target, required_numbers=-1, partial=[], partial_sum=0):
     if len(partial) == required_numbers and partial_sum == target:
         yield partial
@@ -38,50 +58,173 @@ def subset_sum(numbers, target, required_numbers=-1, partial=[], partial_sum=0):
 class FlagLengthError(Exception):
     pass
 
+FLAG_TABLE_MAGIC = b'CHADFLG1'
+FLAG_TABLE_HEADER = struct.Struct('<8s32sIIII')
+FLAG_TABLE_BUCKET = struct.Struct('<III')
+FLAG_TABLE_COMBINATIONS = struct.Struct('<II')
+
+class FlagTable:
+    """
+    Word buckets (by length) and combinations of word lengths for `FlagGenerator`, precomputed into a binary file
+    which is then memory-mapped (so it's shared between every process using it). The file is rebuilt whenever the
+    word list or parameters change.
+    """
+    def __init__(self, path, wordlist='CHAD/nouns.txt', words=4, max_length=64):
+        with open(wordlist, 'rb') as f:
+            nouns = f.read()
+        digest = hashlib.sha256(nouns + struct.pack('<II', words, max_length)).digest()
+        if not self._valid(path, digest):
+            self._build(path, nouns.decode('utf-8'), digest, words, max_length)
+
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        _, _, self.words_per_flag, self.max_length, self.buckets, self.targets = \
+            FLAG_TABLE_HEADER.unpack_from(self.data)
+        self.combinations_index = FLAG_TABLE_HEADER.size + self.buckets * FLAG_TABLE_BUCKET.size
+
+        self.max_word_length = max(filter(lambda l: self.bucket(l)[1], range(self.buckets)))
+        self.min_combination_length = min(filter(self.combinations, range(self.targets)))
+
+    @staticmethod
+    def _valid(path, digest):
+        try:
+            with open(path, 'rb') as f:
+                magic, file_digest, *_ = FLAG_TABLE_HEADER.unpack(f.read(FLAG_TABLE_HEADER.size))
+        except (FileNotFoundError, struct.error):
+            return False
+        return magic == FLAG_TABLE_MAGIC and file_digest == digest
+
+    @staticmethod
+    def _build(path, nouns, digest, words, max_length):
+        buckets = {}
+        for word in nouns.split('\n'):
+            word = word.strip()
+            if word:
+                buckets.setdefault(len(word), []).append(word.encode('utf-8'))
+        lengths = sorted(buckets.keys())
+        combinations = {}
+        for l in range(lengths[0], max_length + 1):
+            combinations[l] = list(subset_sum(lengths, l, words))
+
+        n_buckets = lengths[-1] + 1
+        offset = FLAG_TABLE_HEADER.size + n_buckets * FLAG_TABLE_BUCKET.size + \
+            (max_length + 1) * FLAG_TABLE_COMBINATIONS.size
+        index = bytearray()
+        data = bytearray()
+        # Words in a bucket are padded to the same number of bytes (they're only the same number of characters)
+        for l in range(n_buckets):
+            bucket = buckets.get(l, [])
+            width = max(map(len, bucket), default=0)
+            index += FLAG_TABLE_BUCKET.pack(offset + len(data), len(bucket), width)
+            for word in bucket:
+                data += word.ljust(width, b'\0')
+        for l in range(max_length + 1):
+            index += FLAG_TABLE_COMBINATIONS.pack(offset + len(data), len(combinations.get(l, [])))
+            for combination in combinations.get(l, []):
+                data += bytes(combination)
+
+        # Write to a temporary file and rename it into place so that other processes never see a partial table
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.flags')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(FLAG_TABLE_HEADER.pack(FLAG_TABLE_MAGIC, digest, words, max_length, n_buckets, max_length + 1))
+            f.write(index)
+            f.write(data)
+        os.replace(tmp, path)
+
+    def bucket(self, length):
+        if length >= self.buckets:
+            return 0, 0, 0
+        return FLAG_TABLE_BUCKET.unpack_from(self.data, FLAG_TABLE_HEADER.size + length * FLAG_TABLE_BUCKET.size)
+    def word(self, length, i):
+        offset, _, width = self.bucket(length)
+        return self.data[offset + i * width:offset + (i + 1) * width].rstrip(b'\0').decode('utf-8')
+
+    def combinations(self, length):
+        if length >= self.targets:
+            return 0
+        return FLAG_TABLE_COMBINATIONS.unpack_from(
+            self.data, self.combinations_index + length * FLAG_TABLE_COMBINATIONS.size)[1]
+    def combination(self, length, i):
+        offset, _ = FLAG_TABLE_COMBINATIONS.unpack_from(
+            self.data, self.combinations_index + length * FLAG_TABLE_COMBINATIONS.size)
+        return list(self.data[offset + i * self.words_per_flag:offset + (i + 1) * self.words_per_flag])
+
 # An XKCD 936-compliant (https://xkcd.com/936/) flag generator
 class FlagGenerator:
-    def __init__(self, prefix='CTF', words=4, max_length=64):
+    def __init__(self, prefix='CTF', words=4, max_length=64, table='/var/lib/chad/flags.bin'):
         self.prefix = prefix
         self.words_per_flag = words
         self.fixed_space = len(self.prefix) + 1 + (self.words_per_flag - 1) + 1
 
         self.random = random.Random()
 
-        self.words = {}
-        with open('CHAD/nouns.txt') as wordlist:
-            for word in wordlist:
-                word = word.strip()
-                l = len(word)
-                if l not in self.words:
-                    self.words[l] = []
-                self.words[l].append(word)
+        self.table = FlagTable(table, words=self.words_per_flag, max_length=max_length)
 
         self.max_length = max_length
-        if (max(self.words.keys()) * self.words_per_flag) + self.fixed_space < self.max_length:
+        if (self.table.max_word_length * self.words_per_flag) + self.fixed_space < self.max_length:
             raise FlagLengthError(f'Not enough long words to produce up to {self.max_length} character flags')
-
-        self.length_combinations = {}
-        lengths = list(self.words.keys())
-        for l in range(min(self.words.keys()), self.max_length + 1):
-            combinations = list(subset_sum(lengths, l, self.words_per_flag))
-            if combinations:
-                self.length_combinations[l] = combinations
-        self.min_length = min(self.length_combinations.keys()) + self.fixed_space
+        self.min_length = self.table.min_combination_length + self.fixed_space
 
     def format_flag(self, flag):
         return f'{self.prefix}{{{flag}}}'
+    def _check_length(self, length):
+        combinations = 0
+        if self.min_length <= length <= self.max_length:
+            combinations = self.table.combinations(length - self.fixed_space)
+        if not combinations:
+            raise FlagLengthError(f'Impossible to generate a {self.words_per_flag} word flag which is ' +
+                f'{length} characters')
+        return combinations
+
+    def _draw(self, length, combinations):
+        lengths = self.table.combination(length - self.fixed_space, self.random.randrange(combinations))
+        self.random.shuffle(lengths)
+        return self.format_flag('_'.join(map(
+            lambda l: self.table.word(l, self.random.randrange(self.table.bucket(l)[1])), lengths)))
+
     def next_flag(self, length=None):
         if not length:
             length = self.random.randrange(self.min_length, self.max_length + 1)
+        return self._draw(length, self._check_length(length))
+    def next_flags(self, count, length=None):
+        if not length:
+            return [self.next_flag() for _ in range(count)]
 
-        if length < self.min_length or length > self.max_length:
-            raise FlagLengthError(f'Impossible to generate a {self.words_per_flag} word flag which is ' +
-                f'{length} characters')
+        combinations = self._check_length(length)
+        return [self._draw(length, combinations) for _ in range(count)]
 
-        length -= self.fixed_space
-        lengths = list(self.random.choice(self.length_combinations[length]))
-        self.random.shuffle(lengths)
-        return self.format_flag('_'.join(map(lambda l: self.random.choice(self.words[l]), lengths)))
+class DaemonError(Exception):
+    pass
+class Daemon(ABC):
+    "Plumbing shared by the long-running processes (cleanup, workers etc.), which stop on SIGINT / SIGTERM"
+    error = DaemonError
+
+    def __init__(self, name):
+        self.running = False
+        self.exit = threading.Event()
+        self.id = f'{socket.gethostname()}:{os.getpid()}'
+
+        self.logger = logging.getLogger(name)
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('[{asctime}] [{module}] {levelname}: {message}', style='{'))
+        self.logger.addHandler(handler)
+        self.logger.setLevel(logging.DEBUG if os.getenv('DEBUG') else logging.INFO)
+
+    @abstractmethod
+    def loop(self):
+        pass
+
+    def run(self):
+        if self.running:
+            raise self.error('Already running')
+
+        self.running = True
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        self.loop()
+    def stop(self, _signum, _frame):
+        self.exit.set()
 
 def parse_body(schema: Schema):
     def decorator(fn):
@@ -13,6 +13,16 @@ if [ -z "$CLEANUP_DISABLED" ]; then
     python -m CHAD cleanup &
 fi
 
+if [ -z "$WORKER_DISABLED" ]; then
+    python -m CHAD worker &
+    python -m CHAD worker --prepull &
+fi
+
+# Only the in-process backend takes keys from the pool
+if [ "$PKI_BACKEND" = cryptography ] && [ "${PKI_KEY_POOL_SIZE:-0}" -gt 0 ]; then
+    python -m CHAD keygen &
+fi
+
 if [ -n "$DEBUG" ]; then
     FLASK_ENV=development exec python -m CHAD serve
 else
@@ -21,7 +21,23 @@ def create(args):
         'service': args.service,
         'flag': args.flag
     }
-    res = requests.post(f'{args.host}/instances/{args.user_id}/{args.challenge_id}', json=body)
+    params = {'async': 1} if args.async_ else None
+    res = requests.post(f'{args.host}/instances/{args.user_id}/{args.challenge_id}', params=params, json=body)
+    pfallback(res)
+
+def prepull(args):
+    with open(args.stack) as stack_file:
+        stack = yaml.safe_load(stack_file)
+
+    res = requests.post(f'{args.host}/images/prepull', json={'stack': stack})
+    pfallback(res)
+
+def job(args):
+    res = requests.get(f'{args.host}/jobs/{args.job_id}')
+    pfallback(res)
+
+def flags(args):
+    res = requests.post(f'{args.host}/flags/batch', json={'count': args.count, 'length': args.length})
     pfallback(res)
 
 def ping(args):
@@ -29,8 +45,17 @@ def ping(args):
     if res.status_code != 204:
         pfallback(res)
 
+def ls(args):
+    res = requests.get(f'{args.host}/instances/{args.user_id}')
+    pfallback(res)
+
+def heartbeat(args):
+    res = requests.patch(f'{args.host}/instances/{args.user_id}', json={'challenges': args.challenge_ids})
+    pfallback(res)
+
 def reset(args):
-    res = requests.put(f'{args.host}/instances/{args.user_id}/{args.challenge_id}')
+    params = {'wait': 1} if args.wait else None
+    res = requests.put(f'{args.host}/instances/{args.user_id}/{args.challenge_id}', params=params)
     if res.status_code != 204:
         pfallback(res)
 
@@ -54,16 +79,40 @@ def main():
         help='Don\'t request flag')
     c_create_flag.add_argument('-f', '--flag', help='Flag to use')
     c_create_flag.add_argument('--flag-length', type=int, dest='flag', help='Length of random flag')
+    c_create.add_argument('-a', '--async', action='store_true', dest='async_', help='Create in the background')
     c_create.add_argument('stack', help='Path to stack YAML')
     c_create.add_argument('service', help='Primary challenge service')
 
+    c_prepull = commands.add_parser('prepull', help='Pull challenge images onto every node')
+    c_prepull.set_defaults(fn=prepull)
+    c_prepull.add_argument('stack', help='Path to stack YAML')
+
+    c_job = commands.add_parser('job', help='Get background job status')
+    c_job.set_defaults(fn=job)
+    c_job.add_argument('job_id', help='Job ID')
+
+    c_flags = commands.add_parser('flags', help='Generate a batch of unique flags')
+    c_flags.set_defaults(fn=flags)
+    c_flags.add_argument('-l', '--length', type=int, help='Length of flags')
+    c_flags.add_argument('count', type=int, help='Number of flags')
+
     c_ping = commands.add_parser('ping', help='Ping challenge')
     c_ping.set_defaults(fn=ping)
     c_ping.add_argument('-u', '--user-id', type=int, default=1, help='User ID')
     c_ping.add_argument('-c', '--challenge-id', type=int, default=1, help='Challenge ID')
 
+    c_ls = commands.add_parser('ls', help='List challenges')
+    c_ls.set_defaults(fn=ls)
+    c_ls.add_argument('-u', '--user-id', type=int, default=1, help='User ID')
+
+    c_heartbeat = commands.add_parser('heartbeat', help='Ping several challenges at once')
+    c_heartbeat.set_defaults(fn=heartbeat)
+    c_heartbeat.add_argument('-u', '--user-id', type=int, default=1, help='User ID')
+    c_heartbeat.add_argument('challenge_ids', type=int, nargs='+', help='Challenge IDs')
+
     c_reset = commands.add_parser('reset', help='Reset challenge')
     c_reset.set_defaults(fn=reset)
+    c_reset.add_argument('-w', '--wait', action='store_true', help='Wait for services to come back up')
     c_reset.add_argument('-u', '--user-id', type=int, default=1, help='User ID')
     c_reset.add_argument('-c', '--challenge-id', type=int, default=1, help='Challenge ID')
 